@@ -1,9 +1,49 @@
 import time
+import threading
 import RNS
 import os
+import re
 import urllib
 
 
+# Status of the answer to a conditional request when the body we
+# already have (given by its SHA-256) is still the current one
+NOT_MODIFIED = "21"
+
+# Several paths of a node can be asked in one request to MULTI_PATH with
+# {"paths": [...], "sha256": {path: digest}} as data. The body of the
+# answer is the list of the [header, body] of each path, in the same
+# order, or None for a path the server wants to be asked on its own.
+MULTI_PATH = "/.multi"
+
+# A node caching for others answers requests to GATEWAY_PATH with
+# {"url": url, "since": time} as data: "20 <type> <fetch time>" and its
+# copy of any URL (http, gemini, gopher...) if it is newer than since,
+# NOT_MODIFIED if it isn't and 51 if it has none.
+GATEWAY_PATH = "/.url"
+
+# A header is "<status> <type> <meta>", the type keeping its parameters
+# ("20 text/gemini; charset=utf-8", "51 text/gemini Not found")
+HEADER = re.compile(r"(\S+)\s*([^\s;]*(?:\s*;\s*[^;\s]+)*)\s*(.*)", re.DOTALL)
+
+
+class RRTPError(Exception):
+    pass
+
+
+class RRTPLinkClosed(RRTPError, ConnectionError):
+    pass
+
+
+class RRTPTimeout(RRTPError, TimeoutError):
+    pass
+
+
+class RRTPUnreachable(RRTPError, ConnectionError):
+    # No path to the node, or no link could be established with it
+    pass
+
+
 class RRTPResponseObject:
     response: bytes
     status: str
@@ -11,6 +51,7 @@ class RRTPResponseObject:
     meta: str
     body: bytes
     ok: bool
+    size: int
 
     def __init__(self):
         self.response = None
@@ -19,6 +60,41 @@ class RRTPResponseObject:
         self.meta = ""
         self.body = None
         self.ok = False
+        # bytes received
+        self.size = 0
+
+
+def get_reticulum(configdir=None):
+    # Reticulum can only be started once per process: every RRTPRequest
+    # shares the same instance, started on first use. If a shared instance
+    # (usually rnsd) is running for this configuration, RNS attaches to it
+    # instead of bringing up the interfaces itself.
+    instance = RNS.Reticulum.get_instance()
+    if instance is None:
+        instance = RNS.Reticulum(configdir)
+    return instance
+
+
+def load_identity(path):
+    # The client identity is kept on disk so a node sees the same
+    # client across requests and runs.
+    if path and os.path.isfile(path):
+        identity = RNS.Identity.from_file(path)
+        if identity:
+            return identity
+    identity = RNS.Identity()
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        identity.to_file(path)
+    return identity
+
+
+def destination_hash(destination_hexhash):
+    length = RNS.Reticulum.TRUNCATED_HASHLENGTH // 8
+    if len(destination_hexhash) != length * 2:
+        raise ValueError("Destination length is invalid, must be %s hexadecimal characters (%s bytes)"
+                         % (length * 2, length))
+    return bytes.fromhex(destination_hexhash)
 
 
 def parse_url(url):
@@ -29,146 +105,648 @@ def parse_url(url):
     path = parsed.path
     if path == "":
         path = "/"
+    # answers to an input status are sent as the query
+    if parsed.query:
+        path += "?" + parsed.query
     return parsed.netloc, path
 
 
-def request_failed(request_receipt):
-    RNS.log("The request " + RNS.prettyhexrep(request_receipt.request_id) + " failed.")
-
+class PathListener:
+    # Wakes up the requests waiting for a path as soon as the announce
+    # or the path response of their destination arrives.
+    # Every RRTP node heard is also recorded in known.
+    def __init__(self, known):
+        self.aspect_filter = "rrtp.server"
+        self.receive_path_responses = True
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.known = known
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        if announced_identity:
+            self.known[destination_hash] = (announced_identity.get_public_key(),
+                                            RNS.Transport.hops_to(destination_hash), time.time())
+        with self.lock:
+            event = self.waiting.pop(destination_hash, None)
+        if event:
+            event.set()
+
+    def request_path(self, destination_hash):
+        with self.lock:
+            event = self.waiting.setdefault(destination_hash, threading.Event())
+        RNS.Transport.request_path(destination_hash)
+        return event
+
+    def await_path(self, destination_hash, timeout):
+        if RNS.Transport.has_path(destination_hash):
+            return True
+        if timeout <= 0:
+            return False
+        # The path might already have been requested by request_paths
+        with self.lock:
+            event = self.waiting.get(destination_hash)
+        if not event:
+            event = self.request_path(destination_hash)
+        # The path may have been learned before we started waiting
+        if not RNS.Transport.has_path(destination_hash):
+            event.wait(timeout)
+        if RNS.Transport.has_path(destination_hash):
+            return True
+        # Next time, the path will be requested again
+        with self.lock:
+            if self.waiting.get(destination_hash) is event:
+                self.waiting.pop(destination_hash)
+        return False
+
+
+def link_rate(link):
+    # bits/s measured on the link: by the last resource transferred or
+    # else by the link establishment. None until it is established.
+    return link.get_expected_rate() or link.get_establishment_rate()
+
+
+class PendingRequest:
+    # A request sent over a link, completed by the RNS callbacks.
+    # Several of them can be in flight over the same link.
+    def __init__(self, link, path, timeout, max_size=None, progress=None):
+        self.link = link
+        self.path = path
+        self.timeout = timeout
+        self.max_size = max_size
+        # called with the fraction received while the response is
+        # transferred as a resource
+        self.progress = progress
+        self.receipt = None
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+    def receiving(self):
+        # The response is announced (its resource advertised) or arriving
+        return self.receipt is not None and \
+            (self.receipt.get_status() == RNS.RequestReceipt.RECEIVING
+             or self.receipt.response_transfer_size is not None)
+
+    def transfer_time(self):
+        # Time the response should take to arrive at the rate measured on
+        # the link, None while we don't know its size or the rate.
+        size = self.receipt.response_transfer_size
+        rate = link_rate(self.link)
+        if not size or not rate:
+            return None
+        return size * 8 / rate
+
+    def wait(self):
+        # We give up if nothing happened after the timeout. A response
+        # being received gets twice the time its size needs, plus the grace
+        # RNS gives to a stalled transfer before failing it.
+        started = time.time()
+        while not self.done.wait(self.timeout):
+            if not self.receiving():
+                raise RRTPTimeout("No response for " + self.path)
+            transfer_time = self.transfer_time()
+            if transfer_time and time.time() - started > \
+                    self.timeout + 2 * transfer_time + RNS.Resource.RESPONSE_MAX_GRACE_TIME:
+                raise RRTPTimeout("Receiving %s takes too long" % self.path)
+        if self.error:
+            raise self.error
+        if not self.response:
+            if self.max_size:
+                raise RRTPError("Request for %s failed (or response larger than %s bytes)"
+                                % (self.path, self.max_size))
+            raise RRTPError("Request for " + self.path + " failed")
+        return self.response
 
-def link_closed(link):
-    if link.teardown_reason == RNS.Link.TIMEOUT:
-        RNS.log("The link timed out, exiting now")
-    elif link.teardown_reason == RNS.Link.DESTINATION_CLOSED:
-        RNS.log("The link was closed by the server, exiting now")
-    else:
-        RNS.log("Link closed, exiting now")
 
-    RNS.Reticulum.exit_handler()
-    time.sleep(1.5)
-    os._exit(0)
+def request_failed(request_receipt):
+    RNS.log("The request " + RNS.prettyhexrep(request_receipt.request_id) + " failed.")
 
 
 class RRTPRequest:
+    # Established links are pooled by destination hash. A link unused for
+    # LINK_IDLE_TIMEOUT seconds is torn down, and when MAX_LINKS links are
+    # open the least recently used one without request in progress is
+    # closed to make room.
+    LINK_IDLE_TIMEOUT = 300
+    MAX_LINKS = 8
+    # Seconds to wait for a path and for a link to be established
+    PATH_TIMEOUT = 15
+    LINK_TIMEOUT = 15
+    # A request times out after the time to process it (MIN_REQUEST_TIMEOUT),
+    # RTT_FACTOR round trips and twice the time the expected response
+    # takes at the link rate, within MAX_REQUEST_TIMEOUT. Unanswered
+    # requests are sent again up to RETRIES times, after RETRY_DELAY
+    # seconds doubled at each retry, with a timeout doubled as well.
+    MIN_REQUEST_TIMEOUT = 1
+    MAX_REQUEST_TIMEOUT = 300
+    RTT_FACTOR = 6
+    RETRIES = 1
+    RETRY_DELAY = 0.5
+    # Destinations not answering path requests are not asked again for
+    # BACKOFF seconds, doubled after each new failure: their requests fail
+    # immediately
+    BACKOFF = 600
+    MAX_BACKOFF = 86400
+
     def link_established(self, link):
-        self.link = link
         RNS.log("Link established with server")
+        self.link_ready.pop(link.link_id, threading.Event()).set()
+
+    def link_closed(self, link):
+        if link.teardown_reason == RNS.Link.TIMEOUT:
+            reason = "The link timed out"
+        elif link.teardown_reason == RNS.Link.DESTINATION_CLOSED:
+            reason = "The link was closed by the server"
+        else:
+            reason = "The link was closed"
+        RNS.log(reason)
+        # Wake up a request still waiting for this link to be established
+        self.link_ready.pop(link.link_id, threading.Event()).set()
+        stats = self.get_stats(link.destination.hash)
+        # The link will be re-established by the next request
+        with self.links_lock:
+            for destination_hash, pooled in list(self.links.items()):
+                if pooled is link:
+                    self.links.pop(destination_hash)
+                    self.last_used.pop(destination_hash, None)
+            # Requests still waiting on this link won't get their response
+            for request_id, pending in list(self.pending.items()):
+                if pending.link is link:
+                    stats["failures"] += 1
+                    pending.error = RRTPLinkClosed(reason + " before " + pending.path + " was received")
+                    self.pending.pop(request_id)
+                    pending.done.set()
+
+    def close_link(self, destination_hash):
+        with self.links_lock:
+            link = self.links.pop(destination_hash, None)
+            self.last_used.pop(destination_hash, None)
+        if link and link.status != RNS.Link.CLOSED:
+            link.teardown()
+
+    def sweep_links(self):
+        now = time.time()
+        with self.links_lock:
+            pooled = list(self.links.items())
+        for destination_hash, link in pooled:
+            if link.status == RNS.Link.CLOSED:
+                self.close_link(destination_hash)
+            elif not self.is_busy(link) and \
+                    now - self.last_used.get(destination_hash, now) > self.link_idle_timeout:
+                RNS.log("Closing idle link to " + RNS.prettyhexrep(destination_hash))
+                self.close_link(destination_hash)
+
+    def is_busy(self, link):
+        # Requests are waiting for their response on this link
+        return any(p.link is link for p in list(self.pending.values()))
+
+    def sweep_job(self):
+        while True:
+            time.sleep(min(self.link_idle_timeout, 30))
+            self.sweep_links()
+
+    def get_link(self, destination_hash):
+        self.sweep_links()
+        with self.links_lock:
+            connecting = self.connecting.setdefault(destination_hash, threading.Lock())
+        # Concurrent requests to a destination wait for the same link
+        with connecting:
+            return self.open_link(destination_hash)
+
+    def open_link(self, destination_hash):
+        link = self.links.get(destination_hash)
+        # Health check: only an active link can carry requests
+        if link and link.status != RNS.Link.ACTIVE:
+            self.close_link(destination_hash)
+            link = None
+        if not link:
+            while len(self.links) >= self.max_links:
+                # Links with requests in progress are kept: when they are
+                # all busy, there are more than max_links for a while
+                with self.links_lock:
+                    idle = [h for h, l in self.links.items() if not self.is_busy(l)]
+                if not idle:
+                    break
+                oldest = min(idle, key=lambda h: self.last_used.get(h, 0))
+                self.close_link(oldest)
+
+            server_identity = self.recall_identity(destination_hash)
+            if not server_identity:
+                raise RRTPUnreachable("Unknown identity for " + RNS.prettyhexrep(destination_hash))
+
+            RNS.log("Establishing link with server...")
+
+            destination = RNS.Destination(
+                server_identity,
+                RNS.Destination.OUT,
+                RNS.Destination.SINGLE,
+                "rrtp",
+                "server"
+            )
 
-    def handle_response(self, request_receipt):
-        raw_response = request_receipt.response
-        self.responded = True
-        self.response = RIPResponseObject()
+            started = time.time()
+            link = RNS.Link(destination)
+            ready = threading.Event()
+            self.link_ready[link.link_id] = ready
+
+            link.set_link_established_callback(self.link_established)
+            link.set_link_closed_callback(self.link_closed)
+
+            # The link may be established before the callbacks are set
+            if link.status != RNS.Link.ACTIVE:
+                ready.wait(self.link_timeout)
+            self.link_ready.pop(link.link_id, None)
+
+            if link.status != RNS.Link.ACTIVE:
+                link.teardown()
+                if not RNS.Transport.has_path(destination_hash) and destination_hash in self.known:
+                    # Not a neighbour anymore: wait for a path next time
+                    public_key, hops, last_seen = self.known[destination_hash]
+                    self.known[destination_hash] = (public_key, RNS.Transport.PATHFINDER_M, last_seen)
+                raise RRTPUnreachable("Could not establish link with " + RNS.prettyhexrep(destination_hash))
+
+            if self.identify:
+                # Lets nodes serving only some identities answer us
+                link.identify(self.identity)
+
+            stats = self.get_stats(destination_hash)
+            stats["links"] += 1
+            stats["link_time"] = time.time() - started
+            stats["rtt"] = link.rtt
+            with self.links_lock:
+                self.links[destination_hash] = link
+        self.last_used[destination_hash] = time.time()
+        return link
+
+    def handle_response(self, request_receipt, pending):
+        try:
+            pending.response = self.parse_response(request_receipt)
+            stats = self.get_stats(pending.link.destination.hash)
+            with self.links_lock:
+                stats["requests"] += 1
+                stats["bytes"] += request_receipt.response_transfer_size or pending.response.size
+                stats["transfer_time"] += request_receipt.get_response_time() or 0
+                stats["rtt"] = pending.link.rtt
+        finally:
+            self.request_done(request_receipt, pending)
+
+    def handle_progress(self, request_receipt, pending):
+        if pending.progress and request_receipt.status == RNS.RequestReceipt.RECEIVING:
+            pending.progress(request_receipt.progress)
+
+    def handle_failure(self, request_receipt, pending):
+        request_failed(request_receipt)
+        with self.links_lock:
+            self.get_stats(pending.link.destination.hash)["failures"] += 1
+        self.request_done(request_receipt, pending)
+
+    def get_stats(self, destination_hash):
+        # Transport statistics of a destination, by hexadecimal hash:
+        # last path discovery and link establishment times (s), last rtt (s),
+        # links established, requests answered and failed, bytes received
+        # and time spent receiving them (s).
+        with self.links_lock:
+            return self.stats.setdefault(RNS.hexrep(destination_hash, delimit=False), {
+                "path_time": None,
+                "link_time": None,
+                "rtt": None,
+                "links": 0,
+                "requests": 0,
+                "failures": 0,
+                "bytes": 0,
+                "transfer_time": 0.0,
+            })
+
+    def request_done(self, request_receipt, pending):
+        with self.links_lock:
+            self.pending.pop(request_receipt.request_id, None)
+            pending.done.set()
+
+    def parse_response(self, request_receipt):
+        if request_receipt.metadata is not None:
+            # A server can answer with a file and the header as metadata:
+            # the body is then an open file, that RNS received on disk.
+            # RNS closes and deletes its file once the callback returns,
+            # we keep our own handle on it.
+            received = request_receipt.response
+            body = os.fdopen(os.dup(received.fileno()), "rb")
+            body.seek(0)
+            raw_response = [request_receipt.metadata, body]
+        else:
+            raw_response = request_receipt.response
+        response = self.parse_raw_response(raw_response)
+        if request_receipt.response_size:
+            response.size = request_receipt.response_size
+        return response
+
+    def parse_raw_response(self, raw_response):
+        # The body is left as received: bytes, str or, for a resource,
+        # an open file. Decoding it is up to the caller, from the type.
+        response = RRTPResponseObject()
+        response.response = raw_response
         header = raw_response[0]
-        header = header.split(" ", maxsplit=2)
-        self.response.status = header[0]
-        self.response.type = header[1]
-        if len(header) > 2:
-            self.response.meta = header[2]
+        if isinstance(header, bytes):
+            header = header.decode("utf-8")
+        match = HEADER.match(header.strip())
+        if not match:
+            raise RRTPError("Invalid response header: %r" % header)
+        response.status, response.type, response.meta = match.groups()
 
         if raw_response[1]:
-            self.response.body = raw_response[1]
-
-        self.response.ok = True
-
-    def blocking_request(self, path, data=None):
-        self.responded = False
-        self.response = None
-        self.status = ""
-        self.type = ""
-        self.meta = ""
-        self.ok = False
+            response.body = raw_response[1]
+            if isinstance(response.body, (bytes, str)):
+                response.size = len(response.body)
+
+        response.ok = response.status.startswith("2")
+        return response
+
+    def request_timeout(self, link, expected_size=None, attempt=0):
+        timeout = self.MIN_REQUEST_TIMEOUT
+        if link.rtt:
+            timeout += self.RTT_FACTOR * link.rtt
+        rate = link_rate(link)
+        if expected_size and rate:
+            timeout += 2 * expected_size * 8 / rate
+        return min(timeout * 2 ** attempt, self.MAX_REQUEST_TIMEOUT)
+
+    def send_request(self, link, path, data=None, max_size=None, progress=None,
+                     expected_size=None, attempt=0):
+        # Sends the request without waiting: the returned PendingRequest
+        # is completed by the callbacks when the response arrives.
+        # Responses larger than max_size bytes are refused by RNS.
+        timeout = self.request_timeout(link, expected_size, attempt)
+        pending = PendingRequest(link, path, timeout, max_size, progress)
         try:
             RNS.log("Sending request to " + path)
-            self.link.request(
+            receipt = link.request(
                 path,
                 data=data,
-                response_callback=self.handle_response,
-                failed_callback=request_failed,
-                timeout=5,
+                response_callback=lambda r: self.handle_response(r, pending),
+                failed_callback=lambda r: self.handle_failure(r, pending),
+                progress_callback=lambda r: self.handle_progress(r, pending),
+                # RNS also fails a response not progressing for this time
+                timeout=timeout + RNS.Resource.RESPONSE_MAX_GRACE_TIME,
+                max_response_size=max_size,
             )
 
         except Exception as e:
             RNS.log("Error while sending request over the link: " + str(e))
-            self.curr_connected_dest = None
-            self.link.teardown()
-
-        while not self.responded:
-            time.sleep(0.1)
-
-        return
-
-    def req(self, url, data=None):
-        destination_hexhash, path = parse_url(url)
-
+            link.teardown()
+            raise RRTPLinkClosed("Could not send request to " + path) from e
+
+        if not receipt:
+            raise RRTPLinkClosed("Could not send request to " + path)
+        pending.receipt = receipt
+        with self.links_lock:
+            if not pending.done.is_set():
+                self.pending[receipt.request_id] = pending
+        return pending
+
+    def recall_identity(self, dest_hash):
+        identity = RNS.Identity.recall(dest_hash)
+        if identity:
+            return identity
+        if dest_hash in self.known:
+            identity = RNS.Identity(create_keys=False)
+            identity.load_public_key(self.known[dest_hash][0])
+            return identity
+        return None
+
+    def is_neighbour(self, dest_hash):
+        # Packets to a destination without path are broadcast on all the
+        # interfaces, so a node last heard directly (or through the shared
+        # instance) can be linked to without waiting for its path.
+        if dest_hash not in self.known:
+            return False
+        public_key, hops, last_seen = self.known[dest_hash]
+        return hops <= 1
+
+    def get_destination(self, destination_hexhash):
         try:
-            if len(destination_hexhash) != 20:
-                raise ValueError("Destination length is invalid, must be 20 hexadecimal characters (10 bytes)")
-            destination_hash = bytes.fromhex(destination_hexhash)
-
-        except:
-            RNS.log("Invalid destination entered. Check your input!\n")
-            exit()
-
-        if not RNS.Transport.has_path(destination_hash):
+            dest_hash = destination_hash(destination_hexhash)
+        except ValueError as e:
+            raise RRTPError("Invalid destination %s: %s" % (destination_hexhash, e)) from e
+
+        if not RNS.Transport.has_path(dest_hash) and self.is_neighbour(dest_hash):
+            with self.path_listener.lock:
+                requested = dest_hash in self.path_listener.waiting
+            if not requested:
+                self.path_listener.request_path(dest_hash)
+            self.path_deadlines.pop(dest_hash, None)
+        elif not RNS.Transport.has_path(dest_hash):
+            started = time.time()
+            failures, retry_after = self.unreachable.get(dest_hash, (0, 0))
+            if retry_after > started:
+                raise RRTPUnreachable("No path to %s (not asked again before %d seconds)"
+                                  % (RNS.prettyhexrep(dest_hash), retry_after - started))
             RNS.log("Destination is not yet known. Requesting path and waiting for announce to arrive...")
-            RNS.Transport.request_path(destination_hash)
-            while not RNS.Transport.has_path(destination_hash):
-                time.sleep(0.1)
-
-        if self.curr_connected_dest == destination_hash and self.link:
-            self.blocking_request(path, data)
-            return self.response
-
-        server_identity = RNS.Identity.recall(destination_hash)
-
-        RNS.log("Establishing link with server...")
-
-        self.destination = RNS.Destination(
-            server_identity,
-            RNS.Destination.OUT,
-            RNS.Destination.SINGLE,
-            "rrtp",
-            "server"
-        )
-
-        t_link = RNS.Link(self.destination)
-
-        t_link.set_link_established_callback(self.link_established)
-        t_link.set_link_closed_callback(self.destination)
-
-        while not self.link:
-            time.sleep(0.1)
-
-        self.curr_connected_dest = destination_hash
-
-        self.blocking_request(path, data)
-        return self.response
-
-    def get(self, url, params=None):
-        return self.req(url)
-
-    def post(self, url, data, params=None):
-        return self.req(url, data)
-
-    def __init__(self, identity=None):
-        r = RNS.Reticulum()
+            # All the requests to a destination share the deadline given
+            # by request_paths, until it is over
+            deadline = self.path_deadlines.get(dest_hash, 0)
+            if deadline <= started:
+                deadline = started + self.path_timeout
+            if not self.path_listener.await_path(dest_hash, deadline - started):
+                self.path_failed(dest_hash)
+                raise RRTPUnreachable("No path to " + RNS.prettyhexrep(dest_hash))
+            self.path_deadlines.pop(dest_hash, None)
+            self.get_stats(dest_hash)["path_time"] = time.time() - started
+        if dest_hash not in self.known and RNS.Transport.has_path(dest_hash):
+            # path known by RNS before we heard the node
+            identity = RNS.Identity.recall(dest_hash)
+            if identity:
+                self.known[dest_hash] = (identity.get_public_key(),
+                                         RNS.Transport.hops_to(dest_hash), time.time())
+        self.unreachable.pop(dest_hash, None)
+        return dest_hash
+
+    def request_paths(self, urls, timeout=None):
+        # Path requests for all the destinations are sent at once and this
+        # returns without waiting. A request to one of these destinations
+        # then only waits for what is left of the common deadline.
+        now = time.time()
+        deadline = now + (timeout or self.path_timeout)
+        requested = set()
+        for url in urls:
+            try:
+                dest_hash = destination_hash(parse_url(url)[0])
+            except ValueError:
+                continue
+            if dest_hash in requested or RNS.Transport.has_path(dest_hash):
+                continue
+            requested.add(dest_hash)
+            failures, retry_after = self.unreachable.get(dest_hash, (0, 0))
+            # still in backoff: requests to it fail immediately
+            if retry_after <= now:
+                self.path_deadlines[dest_hash] = deadline
+                self.path_listener.request_path(dest_hash)
+        return requested
+
+    def path_failed(self, dest_hash):
+        now = time.time()
+        failures, retry_after = self.unreachable.get(dest_hash, (0, 0))
+        if retry_after <= now:
+            backoff = min(self.BACKOFF * 2 ** failures, self.MAX_BACKOFF)
+            self.unreachable[dest_hash] = (failures + 1, now + backoff)
+
+    def send(self, url, data=None, max_size=None, progress=None, expected_size=None, attempt=0):
+        # Non-blocking form of req(): call wait() on the result to get the
+        # response. Requests to the same destination share its link.
+        # expected_size (bytes), when known, lengthens the timeout.
+        destination_hexhash, path = parse_url(url)
+        destination_hash = self.get_destination(destination_hexhash)
+        return self.send_request(self.get_link(destination_hash), path, data,
+                                 max_size=max_size, progress=progress,
+                                 expected_size=expected_size, attempt=attempt)
+
+    def wait_retrying(self, pending, url, data=None, max_size=None, progress=None,
+                      expected_size=None):
+        # Waits for the response to the request sent for url, sending it
+        # again (with a longer timeout) if it stays unanswered
+        attempt = 0
+        while True:
+            try:
+                return pending.wait()
+            except RRTPTimeout:
+                # A response which started to arrive is not asked again
+                if attempt >= self.retries or pending.receiving():
+                    raise
+            attempt += 1
+            RNS.log("Retrying request for %s (%s/%s)" % (pending.path, attempt, self.retries))
+            time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+            pending = self.send(url, data, max_size=max_size, progress=progress,
+                                expected_size=expected_size, attempt=attempt)
+
+    def req(self, url, data=None, max_size=None, progress=None, expected_size=None):
+        pending = self.send(url, data, max_size=max_size, progress=progress,
+                            expected_size=expected_size)
+        return self.wait_retrying(pending, url, data, max_size=max_size, progress=progress,
+                                  expected_size=expected_size)
+
+    def get(self, url, params=None, max_size=None, progress=None, sha256=None, expected_size=None):
+        # With the sha256 of the body we have, the server may answer
+        # NOT_MODIFIED without body
+        data = None
+        if sha256:
+            data = {"sha256": sha256}
+        return self.req(url, data, max_size=max_size, progress=progress,
+                        expected_size=expected_size)
+
+    def get_through(self, gateway, url, since=None, max_size=None, progress=None):
+        # Asks the node gateway (a destination hash) for its copy of url,
+        # fetched after since (a timestamp)
+        data = {"url": url, "since": since}
+        return self.req("rrtp://" + gateway + GATEWAY_PATH, data, max_size=max_size,
+                        progress=progress)
+
+    def get_many(self, urls, sha256s=None, max_size=None, sizes=None):
+        # Paths of the same destination are asked in one MULTI_PATH request
+        # and destinations are queried concurrently. Returns the response,
+        # or the RRTPError raised, for each url in order. sizes gives the
+        # expected size of the urls known.
+        if not sha256s:
+            sha256s = {}
+        if not sizes:
+            sizes = {}
+        groups = {}
+        results = {}
+        for url in urls:
+            destination_hexhash, path = parse_url(url)
+            groups.setdefault(destination_hexhash, {})[path] = url
+        singles = []
+        batches = []
+        for destination_hexhash, paths in groups.items():
+            if len(paths) > 1 and destination_hexhash not in self.no_multi:
+                url = "rrtp://" + destination_hexhash + MULTI_PATH
+                data = {"paths": list(paths),
+                        "sha256": {p: sha256s[u] for p, u in paths.items() if sha256s.get(u)}}
+                expected_size = sum(sizes.get(u, 0) for u in paths.values())
+                try:
+                    pending = self.send(url, data, max_size=max_size, expected_size=expected_size)
+                    batches.append((destination_hexhash, paths, pending, url, data, expected_size))
+                except RRTPError as e:
+                    for url in paths.values():
+                        results[url] = e
+            else:
+                singles.extend(paths.values())
+        for destination_hexhash, paths, pending, url, data, expected_size in batches:
+            try:
+                response = self.wait_retrying(pending, url, data, max_size=max_size,
+                                              expected_size=expected_size)
+                entries = response.body
+                if not response.ok:
+                    # e.g. rate limited: the same for every path
+                    for url in paths.values():
+                        results[url] = response
+                    continue
+            except RRTPTimeout:
+                # The server doesn't know MULTI_PATH
+                self.no_multi.add(destination_hexhash)
+                entries = []
+            except RRTPError as e:
+                for url in paths.values():
+                    results[url] = e
+                continue
+            for (path, url), entry in zip(paths.items(), entries or []):
+                if entry:
+                    results[url] = self.parse_raw_response(entry)
+            singles.extend(u for u in paths.values() if u not in results)
+        sent = []
+        for url in singles:
+            data = None
+            if sha256s.get(url):
+                data = {"sha256": sha256s[url]}
+            try:
+                sent.append((url, data, self.send(url, data, max_size=max_size,
+                                                  expected_size=sizes.get(url))))
+            except RRTPError as e:
+                results[url] = e
+        for url, data, pending in sent:
+            try:
+                results[url] = self.wait_retrying(pending, url, data, max_size=max_size,
+                                                  expected_size=sizes.get(url))
+            except RRTPError as e:
+                results[url] = e
+        return [results[url] for url in urls]
+
+    def post(self, url, data, params=None, max_size=None, progress=None):
+        return self.req(url, data, max_size=max_size, progress=progress)
+
+    def __init__(self, identity=None, link_idle_timeout=LINK_IDLE_TIMEOUT, max_links=MAX_LINKS,
+                 configdir=None, identify=False):
+        self.reticulum = get_reticulum(configdir)
         self.identity = None
-        self.destination = None
-        self.link = None
-        self.curr_connected_dest = None
-        self.responded = False
-        # raw response
-        self.response = None
-        # response status code
-        self.status = ""
-        # mime type of response
-        self.type = ""
-        # value of meta field
-        self.meta = ""
-        # response body
-        self.body = None
-        # response health
-        self.ok = False
+        # requests waiting for their response, by request id
+        self.pending = {}
+        self.connecting = {}
+        # destinations not answering MULTI_PATH requests
+        self.no_multi = set()
+        # transport statistics, see get_stats
+        self.stats = {}
+        # pool of established links, by destination hash
+        self.links = {}
+        self.last_used = {}
+        self.link_idle_timeout = link_idle_timeout
+        self.max_links = max_links
+        # Reveal our identity to the nodes we link to
+        self.identify = identify
+        self.links_lock = threading.RLock()
+        # events set when a link being established becomes usable, by link id
+        self.link_ready = {}
+        self.path_timeout = self.PATH_TIMEOUT
+        self.link_timeout = self.LINK_TIMEOUT
+        self.retries = self.RETRIES
+        # common deadline of the paths asked by request_paths
+        self.path_deadlines = {}
+        # (failures, retry_after) of destinations without path
+        self.unreachable = {}
+        # (public_key, hops, last_seen) of the RRTP nodes heard, by
+        # destination hash: a link can be established to them without
+        # waiting for an announce
+        self.known = {}
+        self.path_listener = PathListener(self.known)
+        RNS.Transport.register_announce_handler(self.path_listener)
+        sweeper = threading.Thread(target=self.sweep_job, daemon=True)
+        sweeper.start()
 
         if identity:
             self.identity = identity
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# A minimal RRTP server, serving the files of a directory.
+# It answers like a real node and is handy to test offpunk without a mesh:
+#
+#   python3 RRTPServer.py ~/capsule
+#
+# Requests can carry {"sha256": digest} as data: if the file didn't
+# change, the answer is a NOT_MODIFIED header without body. Several
+# files can be asked at once with MULTI_PATH.
+#
+# Subclasses knowing where a URL is cached (find_url) also answer
+# GATEWAY_PATH requests with their copy.
+#
+# Access can be restricted to some client identities (--allow) and each
+# client is limited to a number of requests per minute (--rate), beyond
+# which it gets a 44 (slow down) status.
+import argparse
+import hashlib
+import mimetypes
+import os
+import time
+import RNS
+from RRTPRequest import GATEWAY_PATH, MULTI_PATH, NOT_MODIFIED, get_reticulum, load_identity
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def guess_mime(path):
+    if path.endswith((".gmi", ".gemini")):
+        return "text/gemini"
+    mime, encoding = mimetypes.guess_type(path, strict=False)
+    return mime or "application/octet-stream"
+
+
+class RRTPServer:
+    # Files bigger than this are sent from disk instead of being loaded
+    # in memory (the header then travels as the resource metadata)
+    FILE_RESPONSE_SIZE = 1000000
+    ANNOUNCE_INTERVAL = 1800
+    # Most paths answered by one MULTI_PATH request
+    MAX_MULTI_PATHS = 32
+    # New files are served after at most SCAN_INTERVAL seconds
+    SCAN_INTERVAL = 300
+    # Files serving their directory
+    INDEXES = ("index.gmi",)
+
+    def register_handler(self, path, response_generator):
+        if self.allowed is None:
+            self.destination.register_request_handler(
+                path,
+                response_generator=response_generator,
+                allow=RNS.Destination.ALLOW_ALL,
+            )
+        else:
+            # requests of the other clients are ignored by RNS
+            self.destination.register_request_handler(
+                path,
+                response_generator=response_generator,
+                allow=RNS.Destination.ALLOW_LIST,
+                allowed_list=self.allowed,
+            )
+
+    def register(self, path, filepath):
+        if self.paths.get(path) != filepath:
+            self.paths[path] = filepath
+            self.register_handler(path, self.respond)
+
+    def scan(self):
+        # RNS only knows exact paths: every file gets its handler, and a
+        # directory with an index is served as that index.
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, self.root)
+            prefix = "/" if relative == "." else "/" + relative.replace(os.sep, "/") + "/"
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                self.register(prefix + filename, filepath)
+                if filename in self.INDEXES:
+                    self.register(prefix, filepath)
+                    if prefix != "/":
+                        self.register(prefix.rstrip("/"), filepath)
+        self.last_scan = time.time()
+
+    def open_file(self, filepath):
+        return open(filepath, "rb")
+
+    def file_mime(self, filepath):
+        return guess_mime(filepath)
+
+    def file_digest(self, filepath):
+        return file_digest(filepath)
+
+    def find_url(self, url):
+        # (file, mime) of the copy of url, None if there is none
+        return None
+
+    def answer(self, path, sha256=None, batched=False):
+        return self.answer_file(self.paths.get(path), sha256=sha256, batched=batched)
+
+    def answer_file(self, filepath, sha256=None, batched=False, mime=None, meta=None):
+        if not filepath or not os.path.isfile(filepath):
+            return ["51 text/gemini Not found", None]
+        if not mime:
+            mime = self.file_mime(filepath)
+        if sha256 and sha256 == self.file_digest(filepath):
+            return [NOT_MODIFIED + " " + mime, None]
+        header = "20 " + mime
+        if meta:
+            header += " " + meta
+        f = self.open_file(filepath)
+        if os.path.getsize(filepath) > self.FILE_RESPONSE_SIZE:
+            if batched:
+                # to be asked on its own
+                f.close()
+                return None
+            return [f, header]
+        with f:
+            return [header, f.read()]
+
+    def limited(self, remote_identity, link_id, cost=1):
+        # Token bucket of each client (by identity, or by link for the
+        # anonymous ones): rate requests per minute, as many in a burst.
+        # Returns the seconds to wait if the request is over the limit.
+        if not self.rate:
+            return 0
+        peer = remote_identity.hash if remote_identity else link_id
+        now = time.time()
+        tokens, last = self.buckets.get(peer, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate / 60)
+        if tokens < cost:
+            self.buckets[peer] = (tokens, now)
+            return max(1, round((cost - tokens) * 60 / self.rate))
+        self.buckets[peer] = (tokens - cost, now)
+        return 0
+
+    def respond(self, path, data, request_id, link_id, remote_identity, requested_at):
+        wait = self.limited(remote_identity, link_id)
+        if wait:
+            return ["44 text/gemini %s" % wait, None]
+        sha256 = None
+        if isinstance(data, dict):
+            sha256 = data.get("sha256")
+        return self.answer(path, sha256)
+
+    def respond_url(self, path, data, request_id, link_id, remote_identity, requested_at):
+        if not isinstance(data, dict) or not isinstance(data.get("url"), str):
+            return ["59 text/gemini Bad request", None]
+        wait = self.limited(remote_identity, link_id)
+        if wait:
+            return ["44 text/gemini %s" % wait, None]
+        found = self.find_url(data["url"])
+        if not found:
+            return ["51 text/gemini Not cached", None]
+        filepath, mime = found
+        fetched = int(os.path.getmtime(filepath))
+        since = data.get("since")
+        if isinstance(since, (int, float)) and fetched <= since:
+            return [NOT_MODIFIED + " " + mime, None]
+        return self.answer_file(filepath, mime=mime, meta=str(fetched))
+
+    def respond_many(self, path, data, request_id, link_id, remote_identity, requested_at):
+        if not isinstance(data, dict) or not isinstance(data.get("paths"), list):
+            return ["59 text/gemini Bad request", None]
+        wait = self.limited(remote_identity, link_id,
+                            min(len(data["paths"]), self.MAX_MULTI_PATHS))
+        if wait:
+            return ["44 text/gemini %s" % wait, None]
+        digests = data.get("sha256") or {}
+        entries = []
+        size = 0
+        # Past MAX_MULTI_PATHS paths or FILE_RESPONSE_SIZE bytes, the
+        # client asks the remaining paths on their own
+        for requested in data["paths"]:
+            entry = None
+            if len(entries) < self.MAX_MULTI_PATHS and size < self.FILE_RESPONSE_SIZE:
+                entry = self.answer(requested, digests.get(requested), batched=True)
+                if entry and entry[1]:
+                    size += len(entry[1])
+            entries.append(entry)
+        return ["20 application/x-rrtp-multi", entries]
+
+    def announce(self):
+        self.destination.announce()
+        self.last_announce = time.time()
+
+    def serve_forever(self):
+        while True:
+            if time.time() - self.last_announce > self.ANNOUNCE_INTERVAL:
+                self.announce()
+            if time.time() - self.last_scan > self.SCAN_INTERVAL:
+                self.scan()
+            time.sleep(1)
+
+    def url(self):
+        return "rrtp://" + RNS.hexrep(self.destination.hash, delimit=False) + "/"
+
+    def __init__(self, root, identity=None, configdir=None, allowed=None, rate=None):
+        self.reticulum = get_reticulum(configdir)
+        self.root = os.path.abspath(root)
+        if identity:
+            self.identity = identity
+        else:
+            self.identity = RNS.Identity()
+        self.destination = RNS.Destination(
+            self.identity,
+            RNS.Destination.IN,
+            RNS.Destination.SINGLE,
+            "rrtp",
+            "server"
+        )
+        # identity hashes of the clients allowed, None for everyone
+        self.allowed = allowed
+        # requests per minute and client, None for no limit
+        self.rate = rate
+        # client -> (tokens, time)
+        self.buckets = {}
+        # request path -> file
+        self.paths = {}
+        self.register_handler(MULTI_PATH, self.respond_many)
+        self.register_handler(GATEWAY_PATH, self.respond_url)
+        self.scan()
+        self.last_announce = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a directory over RRTP.")
+    parser.add_argument("directory", help="directory to serve")
+    parser.add_argument("--config", metavar="DIR", help="Reticulum configuration directory")
+    parser.add_argument("--identity", metavar="FILE",
+                        help="identity file, created if needed (keeps the same address across runs)")
+    parser.add_argument("--allow", metavar="HASH", action="append",
+                        help="identity hash of a client allowed to connect (repeatable, default: everyone)")
+    parser.add_argument("--rate", metavar="N", type=int,
+                        help="requests per minute allowed to each client (default: no limit)")
+    args = parser.parse_args()
+    identity = None
+    if args.identity:
+        identity = load_identity(args.identity)
+    allowed = None
+    if args.allow:
+        allowed = [bytes.fromhex(h) for h in args.allow]
+    server = RRTPServer(args.directory, identity=identity, configdir=args.config,
+                        allowed=allowed, rate=args.rate)
+    print("Serving %s at %s" % (server.root, server.url()))
+    server.announce()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Benchmarks of RRTPRequest against RRTPServer.py on a private Reticulum
+# instance: no interface but the local socket between the two processes,
+# so it runs offline and doesn't disturb (nor depend on) a running rnsd.
+#
+#   python3 bench_rrtp.py
+#   python3 bench_rrtp.py --json > before.json
+#   python3 bench_rrtp.py --compare before.json
+#
+# The server serves a synthetic tree, the same for the same options.
+# Every body received is checked against the file it comes from: a wrong
+# answer makes the run fail. With --compare, timings more than
+# --tolerance times slower than the baseline fail it too.
+#
+# Beware: RNS itself sometimes stalls a resource transfer for a few
+# seconds on loopback. Look at the medians rather than the maxima.
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONFIG = """[reticulum]
+  enable_transport = False
+  share_instance = Yes
+  instance_name = %s
+  shared_instance_port = %s
+  instance_control_port = %s
+  panic_on_interface_error = No
+
+[logging]
+  loglevel = 1
+
+[interfaces]
+"""
+
+# Results where lower is better, compared by --compare
+TIMINGS = ("link_setup", "latency", "small_total", "large_total", "many_total", "concurrent_total")
+
+
+def make_tree(directory, pages, page_size, large_size, seed):
+    # Returns the sha256 of each path
+    rng = random.Random(seed)
+    digests = {}
+    for n in range(pages):
+        body = ("# Page %s\n\n" % n).encode()
+        body += bytes(rng.getrandbits(8) % 26 + 97 for i in range(page_size))
+        digests["/%s.gmi" % n] = write(os.path.join(directory, "%s.gmi" % n), body)
+    body = rng.getrandbits(8 * large_size).to_bytes(large_size, "little")
+    digests["/large.bin"] = write(os.path.join(directory, "large.bin"), body)
+    return digests
+
+
+def write(path, body):
+    with open(path, "wb") as f:
+        f.write(body)
+    return hashlib.sha256(body).hexdigest()
+
+
+def body_digest(response):
+    body = response.body
+    if hasattr(body, "read"):
+        with body:
+            body = body.read()
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.sha256(body or b"").hexdigest()
+
+
+def summary(timings):
+    return {
+        "median": round(statistics.median(timings), 4),
+        "min": round(min(timings), 4),
+        "max": round(max(timings), 4),
+    }
+
+
+class Bench:
+
+    def check(self, path, response):
+        if not response.ok or body_digest(response) != self.digests[path]:
+            self.errors.append("%s: wrong answer (%s %s)" % (path, response.status, response.meta))
+
+    def link_setup(self):
+        # First path discovery, then links established again and again
+        started = time.monotonic()
+        destination = self.client.get_destination(self.hexhash)
+        path_time = time.monotonic() - started
+        timings = []
+        for i in range(self.repeat):
+            self.client.close_link(destination)
+            started = time.monotonic()
+            self.client.open_link(destination)
+            timings.append(time.monotonic() - started)
+        return path_time, timings
+
+    def latency(self):
+        # One small page at a time, on an established link
+        timings = []
+        for i in range(self.repeat):
+            started = time.monotonic()
+            response = self.client.get(self.url + "/0.gmi")
+            timings.append(time.monotonic() - started)
+            self.check("/0.gmi", response)
+        return timings
+
+    def small(self):
+        started = time.monotonic()
+        size = 0
+        for path in self.pages:
+            response = self.client.get(self.url + path)
+            self.check(path, response)
+            size += response.size or 0
+        return time.monotonic() - started, size
+
+    def large(self):
+        started = time.monotonic()
+        response = self.client.get(self.url + "/large.bin")
+        elapsed = time.monotonic() - started
+        self.check("/large.bin", response)
+        return elapsed, response.size or 0
+
+    def many(self):
+        # All the pages in MULTI_PATH exchanges
+        started = time.monotonic()
+        responses = self.client.get_many([self.url + path for path in self.pages])
+        elapsed = time.monotonic() - started
+        for path, response in zip(self.pages, responses):
+            if isinstance(response, Exception):
+                self.errors.append("%s: %s" % (path, response))
+            else:
+                self.check(path, response)
+        return elapsed
+
+    def concurrent(self):
+        # Requests sent from several threads at once, on the same link
+        def worker(paths):
+            for path in paths:
+                try:
+                    self.check(path, self.client.get(self.url + path))
+                except Exception as err:
+                    self.errors.append("%s: %s" % (path, err))
+        threads = [threading.Thread(target=worker, args=(self.pages[i::self.threads],))
+                   for i in range(self.threads)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+    def run(self):
+        path_time, link_timings = self.link_setup()
+        latencies = self.latency()
+        small_total, small_size = self.small()
+        large_total, large_size = self.large()
+        many_total = self.many()
+        concurrent_total = self.concurrent()
+        return {
+            "path_discovery": round(path_time, 4),
+            "link_setup": summary(link_timings),
+            "latency": summary(latencies),
+            "small_total": round(small_total, 4),
+            "small_throughput_kBps": round(small_size / 1000 / small_total, 1),
+            "large_total": round(large_total, 4),
+            "large_throughput_kBps": round(large_size / 1000 / large_total, 1),
+            "many_total": round(many_total, 4),
+            "concurrent_total": round(concurrent_total, 4),
+            "errors": self.errors,
+        }
+
+    def __init__(self, client, url, digests, repeat=20, threads=8):
+        self.client = client
+        self.url = url.rstrip("/")
+        self.hexhash = self.url[len("rrtp://"):]
+        self.digests = digests
+        self.pages = sorted((p for p in digests if p.endswith(".gmi")),
+                            key=lambda p: int(p[1:-4]))
+        self.repeat = repeat
+        self.threads = threads
+        self.errors = []
+
+
+def compare(results, baseline, tolerance):
+    # Returns the timings more than tolerance times slower
+    slower = []
+    for name in TIMINGS:
+        new, old = results.get(name), baseline.get(name)
+        if isinstance(new, dict):
+            new, old = new["median"], old["median"]
+        if old and new > old * tolerance:
+            slower.append("%s: %s s, was %s s" % (name, new, old))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RRTP client on a local Reticulum instance.")
+    parser.add_argument("--pages", type=int, default=50, help="small pages (default: 50)")
+    parser.add_argument("--page-size", type=int, default=2000, help="bytes per small page (default: 2000)")
+    parser.add_argument("--large-size", type=int, default=2000000,
+                        help="bytes of the large response (default: 2000000)")
+    parser.add_argument("--repeat", type=int, default=20, help="links and requests timed (default: 20)")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent requesters (default: 8)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the tree")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="slowdown accepted by --compare (default: 1.5)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="offpunk-bench-rrtp-")
+    configdir = os.path.join(workdir, "reticulum")
+    tree = os.path.join(workdir, "tree")
+    os.makedirs(configdir)
+    os.makedirs(tree)
+    # An instance of our own, on a unix socket when the platform has them
+    port = random.Random().randrange(20000, 60000)
+    with open(os.path.join(configdir, "config"), "w") as f:
+        f.write(CONFIG % ("offpunk-bench-%s" % os.getpid(), port, port + 1))
+    digests = make_tree(tree, args.pages, args.page_size, args.large_size, args.seed)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    from RRTPRequest import RRTPRequest
+    # The server starts the instance, the client attaches to it
+    server = subprocess.Popen([sys.executable, "-u", os.path.join(here, "RRTPServer.py"), tree,
+                               "--config", configdir], stdout=subprocess.PIPE, text=True)
+    try:
+        line = server.stdout.readline()
+        if "rrtp://" not in line:
+            sys.exit("RRTPServer.py didn't start")
+        url = line.split()[-1]
+        client = RRTPRequest(configdir=configdir)
+        results = Bench(client, url, digests, repeat=args.repeat, threads=args.threads).run()
+    finally:
+        server.kill()
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("Path discovery:  %s s" % results["path_discovery"])
+        for name in ("link_setup", "latency"):
+            print("%-16s median %s s, min %s s, max %s s" % (name.replace("_", " ").capitalize() + ":",
+                  results[name]["median"], results[name]["min"], results[name]["max"]))
+        print("Small pages:     %s pages in %s s, %s kB/s" % (args.pages, results["small_total"],
+                                                           results["small_throughput_kBps"]))
+        print("Large response:  %s bytes in %s s, %s kB/s" % (args.large_size, results["large_total"],
+                                                             results["large_throughput_kBps"]))
+        print("get_many:        %s pages in %s s" % (args.pages, results["many_total"]))
+        print("%-16s %s pages in %s s" % ("%s threads:" % args.threads, args.pages,
+                                           results["concurrent_total"]))
+    failed = results["errors"]
+    for error in failed:
+        print("ERROR " + error, file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for line in slower:
+            print("SLOWER " + line, file=sys.stderr)
+        failed = failed + slower
+    # RNS threads would keep the process alive
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
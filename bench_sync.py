@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# A synthetic corpus served on localhost over gemini (TLS), gopher,
+# finger, spartan and http, and a benchmark running offpunk's sync
+# against it. Nothing leaves the machine, so sync performance can be
+# measured and compared between builds on any Linux box:
+#
+#   python3 bench_sync.py                  # serve, sync, report
+#   python3 bench_sync.py --latency 200 --bandwidth 50 --errors 0.05
+#   python3 bench_sync.py serve            # only serve (prints the URLs)
+#
+# Servers can add latency (ms before each answer), cap bandwidth (KB/s)
+# and drop a fraction of the requests. Failing requests are chosen from
+# their path, so the same ones fail on every run.
+#
+# The sync runs with a temporary HOME, its own cache and lists, and the
+# report gives the wall time, the throughput and the peak memory.
+import argparse
+import http.server
+import json
+import os
+import random
+import resource
+import shutil
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import redirect_stdout
+
+PROTOCOLS = ("gemini", "gopher", "finger", "spartan", "http")
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua offline smolnet "
+         "capsule gemlog phlog mesh sync cache").split()
+
+
+class Corpus:
+    # pages numbered from 0, each linking to the next ones. The same
+    # options always give the same text.
+    LINKS = 3
+
+    def page(self, n):
+        rng = random.Random("%s:%s" % (self.seed, n))
+        text = []
+        size = 0
+        while size < self.size:
+            line = " ".join(rng.choice(WORDS) for i in range(12))
+            text.append(line)
+            size += len(line) + 1
+        return "\n".join(text)
+
+    def links(self, n):
+        if n is None:
+            return list(range(self.pages))
+        return [(n + i) % self.pages for i in range(1, self.LINKS + 1)]
+
+    def __init__(self, pages=20, size=4000, seed=0):
+        self.pages = pages
+        self.size = size
+        self.seed = seed
+
+
+class Shaper:
+    # Network conditions applied by every server
+
+    def failing(self, path):
+        if not self.errors:
+            return False
+        return random.Random("%s:%s" % (self.seed, path)).random() < self.errors
+
+    def send(self, wfile, data):
+        if self.bandwidth:
+            chunk = 4096
+            for i in range(0, len(data), chunk):
+                wfile.write(data[i:i + chunk])
+                wfile.flush()
+                time.sleep(min(chunk, len(data) - i) / self.bandwidth)
+        else:
+            wfile.write(data)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __init__(self, latency=0, bandwidth=0, errors=0, seed=0):
+        # seconds, bytes per second, fraction of the requests
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errors = errors
+        self.seed = seed
+
+
+def page_number(path):
+    # "/12.gmi", "/0/12", "12"... -> 12, None for an index
+    name = path.rstrip("/").rsplit("/", 1)[-1].split(".")[0]
+    return int(name) if name.isdigit() else None
+
+
+def gemtext(corpus, n):
+    lines = ["# Page %s" % n if n is not None else "# Benchmark corpus", ""]
+    if n is not None:
+        lines.append(corpus.page(n))
+    lines += ["=> /%s.gmi Page %s" % (i, i) for i in corpus.links(n)]
+    return "\n".join(lines) + "\n"
+
+
+class Handler(socketserver.StreamRequestHandler):
+    # Line based protocols: one request line, one answer, then close
+
+    def handle(self):
+        line = self.rfile.readline(4096).decode("utf-8", "replace").strip()
+        server = self.server
+        server.shaper.wait()
+        if server.shaper.failing(server.protocol + line):
+            return
+        answer = getattr(self, "answer_" + server.protocol)(line)
+        server.shaper.send(self.wfile, answer)
+
+    def answer_gemini(self, line):
+        path = urllib.parse.urlparse(line).path or "/"
+        n = page_number(path)
+        if n is not None and n >= self.server.corpus.pages:
+            return b"51 Not found\r\n"
+        return b"20 text/gemini\r\n" + gemtext(self.server.corpus, n).encode()
+
+    def answer_spartan(self, line):
+        host, path, length = line.split(" ")
+        n = page_number(path)
+        if n is not None and n >= self.server.corpus.pages:
+            return b"4 Not found\r\n"
+        return b"2 text/gemini\r\n" + gemtext(self.server.corpus, n).encode()
+
+    def answer_gopher(self, line):
+        selector = line.split("\t")[0]
+        n = page_number(selector)
+        corpus = self.server.corpus
+        host, port = self.server.server_address[:2]
+        if selector.startswith("/0/") and n is not None:
+            return (corpus.page(n) + "\r\n.\r\n").encode()
+        lines = ["iPage %s\t\t%s\t%s" % (n, host, port)] if n is not None else []
+        lines += ["0Page %s\t/0/%s\t%s\t%s" % (i, i, host, port) for i in corpus.links(None)]
+        return ("\r\n".join(lines) + "\r\n.\r\n").encode()
+
+    def answer_finger(self, line):
+        n = page_number(line)
+        if n is None:
+            return b"Nobody here\r\n"
+        return (self.server.corpus.page(n) + "\r\n").encode()
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.shaper.wait()
+        if server.shaper.failing("http" + self.path):
+            self.close_connection = True
+            return
+        n = page_number(self.path)
+        corpus = server.corpus
+        if n is not None and n >= corpus.pages:
+            self.send_error(404)
+            return
+        title = "Page %s" % n if n is not None else "Benchmark corpus"
+        body = "<html><head><title>%s</title></head><body><h1>%s</h1>" % (title, title)
+        if n is not None:
+            body += "<p>%s</p>" % corpus.page(n).replace("\n", "</p><p>")
+        body += "".join('<p><a href="/%s.html">Page %s</a></p>' % (i, i) for i in corpus.links(n))
+        body = (body + "</body></html>").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        server.shaper.send(self.wfile, body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TLSServer(TCPServer):
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True), address
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def make_certificate(directory):
+    # self-signed: offpunk trusts it on first use
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def serve(corpus, shaper, protocols=PROTOCOLS, host="127.0.0.1"):
+    # Starts a server for each protocol on a free port and returns
+    # the URLs to sync, by protocol
+    urls = {}
+    tmpdir = tempfile.mkdtemp(prefix="offpunk-bench-")
+    for protocol in protocols:
+        if protocol == "http":
+            server = HTTPServer((host, 0), HTTPHandler)
+        elif protocol == "gemini":
+            server = TLSServer((host, 0), Handler)
+            server.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server.context.load_cert_chain(*make_certificate(tmpdir))
+        else:
+            server = TCPServer((host, 0), Handler)
+        server.protocol = protocol
+        server.corpus = corpus
+        server.shaper = shaper
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "%s://localhost:%s/" % (protocol, server.server_address[1])
+        if protocol == "finger":
+            # plain text, without links: every page is listed
+            urls[protocol] = [base + str(i) for i in range(corpus.pages)]
+        elif protocol == "gopher":
+            urls[protocol] = [base + "1/"]
+        else:
+            urls[protocol] = [base]
+    shutil.rmtree(tmpdir)
+    return urls
+
+
+def peak_memory():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def directory_size(path):
+    files = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return files, size
+
+
+def bench(urls, depth=1, verbose=False):
+    # offpunk finds its directories when imported
+    home = tempfile.mkdtemp(prefix="offpunk-bench-home-")
+    os.environ["HOME"] = home
+    for variable in ("XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_DATA_HOME"):
+        os.environ[variable] = os.path.join(home, variable.lower())
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import offpunk
+    for directory in (offpunk._CONFIG_DIR, offpunk._CACHE_PATH, offpunk._DATA_DIR):
+        os.makedirs(directory, exist_ok=True)
+    memory_before = peak_memory()
+    output = sys.stdout if verbose else open(os.devnull, "w")
+    with redirect_stdout(output):
+        gc = offpunk.GeminiClient(synconly=True)
+        # the servers only listen on IPv4
+        gc.options["ipv6"] = False
+        gc.list_create("bench")
+        for protocol_urls in urls.values():
+            for url in protocol_urls:
+                gc.list_add_line("bench", gi=offpunk.GeminiItem(url), verbose=False)
+        start = time.monotonic()
+        gc.call_sync(depth=depth)
+        wall = time.monotonic() - start
+    files, size = directory_size(offpunk._CACHE_PATH)
+    shutil.rmtree(home)
+    return {
+        "wall_time": round(wall, 3),
+        "requests": gc.log["requests"],
+        "cached_files": files,
+        "cached_bytes": size,
+        "throughput_kBps": round(size / 1000 / wall, 1) if wall else None,
+        "pages_per_second": round(files / wall, 1) if wall else None,
+        "peak_memory_kB": peak_memory(),
+        "peak_memory_before_sync_kB": memory_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offpunk's sync against a local corpus.")
+    parser.add_argument("command", nargs="?", choices=("bench", "serve"), default="bench")
+    parser.add_argument("--pages", type=int, default=20, help="pages per protocol (default: 20)")
+    parser.add_argument("--size", type=int, default=4000, help="bytes of text per page (default: 4000)")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds before each answer")
+    parser.add_argument("--bandwidth", type=float, default=0, help="KB/s per connection (default: unlimited)")
+    parser.add_argument("--errors", type=float, default=0, help="fraction of the requests dropped")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus and of the errors")
+    parser.add_argument("--protocols", default=",".join(PROTOCOLS),
+                        help="comma separated (default: %s)" % ",".join(PROTOCOLS))
+    parser.add_argument("--depth", type=int, default=1, help="sync depth (default: 1)")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the sync")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    protocols = [p for p in args.protocols.split(",") if p]
+    for protocol in protocols:
+        if protocol not in PROTOCOLS:
+            parser.error("unknown protocol %s" % protocol)
+    corpus = Corpus(pages=args.pages, size=args.size, seed=args.seed)
+    shaper = Shaper(latency=args.latency / 1000, bandwidth=args.bandwidth * 1000,
+                    errors=args.errors, seed=args.seed)
+    # The servers run in their own process: the sync is measured alone
+    if args.command == "serve":
+        urls = serve(corpus, shaper, protocols)
+        print(json.dumps(urls), flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            return
+    command = [sys.executable, os.path.abspath(__file__), "serve"] + sys.argv[1:]
+    if "bench" in command:
+        command.remove("bench")
+    servers = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        urls = json.loads(servers.stdout.readline())
+        results = bench(urls, depth=args.depth, verbose=args.verbose)
+    finally:
+        servers.kill()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("Sync of %s pages (%s) in %s s" % (args.pages, ", ".join(protocols), results["wall_time"]))
+        print("  requests:    %s" % results["requests"])
+        print("  cached:      %s files, %s bytes" % (results["cached_files"], results["cached_bytes"]))
+        print("  throughput:  %s kB/s, %s pages/s" % (results["throughput_kBps"], results["pages_per_second"]))
+        print("  peak memory: %s kB (%s kB before the sync)" % (results["peak_memory_kB"],
+                                                              results["peak_memory_before_sync_kB"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,33 +19,38 @@ import argparse
 import cmd
 import codecs
 import datetime
+import errno
 import fnmatch
 import getpass
 import glob
+import gzip
 import hashlib
 import io
+import json
 import mimetypes
 import os
 import os.path
 import filecmp
 import random
+import selectors
 import shlex
 import shutil
 import socket
+import stat
 import sqlite3
 import ssl
 from ssl import CertificateError
 import sys
 import tempfile
+import threading
 import time
 import urllib.parse
 import uuid
 import webbrowser
 import html
 import base64
+import builtins
 import subprocess
-import RNS
-from RRTPRequest import RRTPRequest
 
 # In terms of arguments, this can take an input file/string to be passed to
 # stdin, a parameter to do (well-escaped) "%" replacement on the command, a
@@ -189,6 +194,35 @@ def parse_mime(mime):
                         options[spl[0]] = spl[1]
     return mime, options
 
+def decode_body(body, mime):
+    # Text is decoded with the charset declared in the mime (UTF-8 if none),
+    # other bodies are kept as they are.
+    shortmime, mime_options = parse_mime(mime)
+    if "charset" in mime_options:
+        try:
+            codecs.lookup(mime_options["charset"])
+        except LookupError:
+            raise RuntimeError("Header declared unknown encoding %s" % mime_options["charset"])
+    if shortmime.startswith("text/") and isinstance(body, bytes):
+        #Get the charset and default to UTF-8 in none
+        encoding = mime_options.get("charset", "UTF-8")
+        try:
+            body = body.decode(encoding)
+        except UnicodeError:
+            raise RuntimeError("Could not decode response body using %s\
+                                encoding declared in header!" % encoding)
+    return body
+
+def read_limited(f, max_length=None):
+    # Reads f to the end, or returns None when it holds more than
+    # max_length bytes (only max_length+1 are read then)
+    if not max_length:
+        return f.read()
+    body = f.read(max_length + 1)
+    if len(body) > max_length:
+        return None
+    return body
+
 _HAS_XSEL = shutil.which('xsel')
 _HAS_XDGOPEN = shutil.which('xdg-open')
 try:
@@ -202,6 +236,12 @@ except ModuleNotFoundError:
 try:
     import requests
     _DO_HTTP = True
+    # Every content-encoding urllib3 is able to decode
+    # (brotli and zstd are included when their module is installed)
+    try:
+        from urllib3.util.request import ACCEPT_ENCODING as _HTTP_ENCODINGS
+    except ImportError:
+        _HTTP_ENCODINGS = "gzip,deflate"
 except ModuleNotFoundError:
     _DO_HTTP = False
 
@@ -229,6 +269,14 @@ try:
 except ModuleNotFoundError:
     _DO_FEED = False
 
+try:
+    from RRTPRequest import RRTPRequest, RRTPError, RRTPLinkClosed, RRTPTimeout, \
+                                RRTPUnreachable, load_identity, NOT_MODIFIED
+    from RRTPServer import RRTPServer
+    _DO_RRTP = True
+except ModuleNotFoundError:
+    _DO_RRTP = False
+
 ## Config directories
 ## We implement our own python-xdg to avoid conflict with existing libraries.
 _home = os.path.expanduser('~')
@@ -249,8 +297,149 @@ if os.path.exists(_old_config):
 if not os.path.exists(data_home) and os.path.exists(_old_config):
     _DATA_DIR = _CONFIG_DIR
 _MAX_REDIRECTS = 5
+# Delay between two parallel connection attempts (RFC 8305)
+_CONNECT_ATTEMPT_DELAY = 0.25
+_DNS_CACHE_SECS = 300
 _MAX_CACHE_SIZE = 10
 _MAX_CACHE_AGE_SECS = 180
+# Text caches are gzipped when "cache_compression" is set. We mark them
+# with a name in the gzip header so they are never confused with
+# downloaded gzip files.
+_COMPRESS_CACHE = False
+_GZIP_NAME = "offpunk"
+# Uncompressed copies of gzipped caches given to external tools, by cache
+# path. They are removed when quitting.
+_UNCOMPRESSED_COPIES = {}
+# URLs first asked to the "rrtp_gateway" node, and served by --serve-rrtp
+_GATEWAY_SCHEMES = ("http", "https", "gemini", "gopher")
+
+def is_compressed_cache(path):
+    marker = _GZIP_NAME.encode() + b"\0"
+    try:
+        with open(path,"rb") as f:
+            header = f.read(10 + len(marker))
+    except OSError:
+        return False
+    # bit 3 of the flags byte means that a file name follows the header
+    return header[:2] == b"\x1f\x8b" and len(header) > 3 \
+                and header[3] & 0x08 and header[10:] == marker
+
+def open_cache(path):
+    # The cached body, as it was received
+    if is_compressed_cache(path):
+        return gzip.open(path)
+    return open(path,"rb")
+
+class CacheIndex():
+    # What we know about the cached items, by URL: mime and charset given
+    # by the server, size, fetch time, status, title and SHA-256 of the
+    # body, so that they don’t have to be guessed again (with "file").
+    # The cache files stay the reference: an entry is only used while
+    # its file has the size and mtime recorded, the cache can still be
+    # modified by hand. Losing the index only costs the guesses again.
+    # The --serve-rrtp gateway reads it from the RNS threads as well.
+    FIELDS = ("mime", "charset", "size", "fetched", "status", "title", "sha256")
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        # it can be rebuilt: no need to wait for the disk
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS items
+            (url text PRIMARY KEY, mime text, charset text, size integer,
+            fetched real, status text, title text, sha256 text)""")
+        self.conn.commit()
+
+    def get(self, url, st):
+        # The entry of url if it describes the file of stat st
+        with self.lock:
+            row = self.conn.execute("SELECT %s FROM items WHERE url = ?" \
+                                    %", ".join(self.FIELDS), (url,)).fetchone()
+        if not row:
+            return None
+        entry = dict(zip(self.FIELDS, row))
+        if entry["size"] != st.st_size or entry["fetched"] != st.st_mtime:
+            return None
+        return entry
+
+    def put(self, url, st, **fields):
+        # A new entry for the file of stat st
+        values = dict.fromkeys(self.FIELDS)
+        values.update(fields, size=st.st_size, fetched=st.st_mtime)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO items (url, %s) VALUES (?%s)" \
+                                %(", ".join(self.FIELDS), ",?"*len(self.FIELDS)),
+                              [url] + [values[f] for f in self.FIELDS])
+            self.conn.commit()
+
+    def update(self, url, **fields):
+        with self.lock:
+            self.conn.execute("UPDATE items SET %s WHERE url = ?" \
+                                %", ".join("%s = ?" %f for f in fields),
+                              list(fields.values()) + [url])
+            self.conn.commit()
+
+_CACHE_INDEX = None
+_CACHE_INDEX_LOCK = threading.Lock()
+def cache_index():
+    # Opened on first use, None until offpunk’s directories exist
+    global _CACHE_INDEX
+    with _CACHE_INDEX_LOCK:
+        if not _CACHE_INDEX and os.path.isdir(_DATA_DIR):
+            _CACHE_INDEX = CacheIndex(os.path.join(_DATA_DIR, "cache_index.db"))
+    return _CACHE_INDEX
+
+if _DO_RRTP:
+    class CacheServer(RRTPServer):
+        # Serves the cache, read-only, as rrtp://node/scheme/host/path
+        INDEXES = ("index.gmi", "index.html", "index.txt")
+
+        def open_file(self, filepath):
+            if not is_compressed_cache(filepath):
+                return open(filepath, "rb")
+            with gzip.open(filepath) as f:
+                if os.path.getsize(filepath) <= self.FILE_RESPONSE_SIZE:
+                    return io.BytesIO(f.read())
+                # RNS only sends a file opened "rb" as a resource, and
+                # stats its name (here a descriptor) to know its size.
+                # The file has no path: it is gone once RNS closes it.
+                with tempfile.TemporaryFile() as tmpf:
+                    shutil.copyfileobj(f, tmpf)
+                    tmpf.flush()
+                    sent = open(os.dup(tmpf.fileno()), "rb")
+            sent.seek(0)
+            return sent
+
+        def file_digest(self, filepath):
+            digest = hashlib.sha256()
+            with open_cache(filepath) as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
+
+        def file_mime(self, filepath):
+            mime = super().file_mime(filepath)
+            if mime == "application/octet-stream" and shutil.which("file"):
+                if is_compressed_cache(filepath):
+                    mime = run("file -bz --mime-type %s", parameter=filepath).strip()
+                else:
+                    mime = run("file -b --mime-type %s", parameter=filepath).strip()
+            return mime
+
+        def find_url(self, url):
+            # The copies we got ourselves, never our local files nor
+            # the error pages written in their place
+            gi = GeminiItem(url)
+            if gi.scheme not in _GATEWAY_SCHEMES or not gi.is_cache_valid():
+                return None
+            entry = gi.cache_entry()
+            if not entry or entry["status"] != "ok":
+                return None
+            path = gi.get_cache_path()
+            if not os.path.isfile(path) or \
+                    not os.path.realpath(path).startswith(os.path.realpath(self.root)):
+                return None
+            return path, gi.get_mime()
 
 _GREP = "grep --color=auto"
 less_version = 0
@@ -385,6 +574,32 @@ standard_ports = {
         "spartan": 300,
 }
 
+# Sync profiles decide when binaries (images, archives, audio…) are fetched
+# during a sync. With "defer_binaries", they are fetched after all the text
+# content. "binary_budget" caps, in Mo, what binaries may download during
+# one sync (None means no cap, 0 means binaries are skipped).
+_SYNC_PROFILES = {
+        "full"      : {"defer_binaries": False, "binary_budget": None},
+        "textfirst" : {"defer_binaries": True,  "binary_budget": None},
+        "metered"   : {"defer_binaries": True,  "binary_budget": 20},
+        "textonly"  : {"defer_binaries": True,  "binary_budget": 0},
+}
+
+# Some application/ types are text we want during the text phase of a sync
+_TEXT_APPLICATION_MIMES = ["application/xml", "application/rss+xml", "application/atom+xml",
+                          "application/xhtml+xml", "application/json", "application/javascript"]
+
+def is_binary_mime(mime):
+    if not mime:
+        return False
+    mime = mime.split(";")[0].strip()
+    if mime.startswith("text/") or mime in _TEXT_APPLICATION_MIMES:
+        return False
+    # feeds (application/x-rss+xml guessed for .rss…) and other xml documents
+    if mime.startswith("application/") and mime.endswith("+xml"):
+        return False
+    return mime == "binary" or mime.split("/")[0] in ("image","audio","video","application","font")
+
 # First, we define the different content->text renderers, outside of the rest
 # (They could later be factorized in other files or replaced)
 class AbstractRenderer():
@@ -1476,10 +1691,19 @@ class GeminiItem():
    
     def get_page_title(self):
         title = ""
+        entry = None
         if not self.renderer:
-            self._set_renderer()
-        if self.renderer:
-            title = self.renderer.get_title()
+            # no need to render the page to know its title again
+            entry = self.cache_entry()
+        if entry and entry["title"] is not None:
+            title = entry["title"]
+        else:
+            if not self.renderer:
+                self._set_renderer()
+            if self.renderer:
+                title = self.renderer.get_title()
+                if entry:
+                    cache_index().update(self.url, title=title)
         if not title or len(title) == 0:
             title = self.get_capsule_title()
         else:
@@ -1500,11 +1724,11 @@ class GeminiItem():
             if len(cache) > 259:
                 print("We return False because path is too long")
                 return False
-            if os.path.exists(cache) and not os.path.isdir(cache):
+            # one stat tells if it exists, is a file and its age
+            st = self.cache_stat()
+            if st and not stat.S_ISDIR(st.st_mode):
                 if validity > 0 :
-                    last_modification = self.cache_last_modified()
-                    now = time.time()
-                    age = now - last_modification
+                    age = time.time() - st.st_mtime
                     return age < validity
                 else:
                     return True
@@ -1515,6 +1739,32 @@ class GeminiItem():
             #There’s not even a cache!
             return False
 
+    def cache_stat(self):
+        try:
+            return os.stat(self.get_cache_path())
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def cache_entry(self):
+        # What the cache index knows about our current cache, if anything
+        index = cache_index()
+        st = self.cache_stat()
+        if self.local or not index or not st or not stat.S_ISREG(st.st_mode):
+            return None
+        return index.get(self.url, st)
+
+    def touch_cache(self, fetched=None):
+        # The cache is as fresh as if fetched now (or at fetched),
+        # its index entry stays valid
+        entry = self.cache_entry()
+        path = self.get_cache_path()
+        if fetched is None:
+            os.utime(path)
+        else:
+            os.utime(path, (fetched, fetched))
+        if entry:
+            cache_index().update(self.url, fetched=os.path.getmtime(path))
+
     def cache_last_modified(self):
         path = self.get_cache_path()
         if path:
@@ -1524,6 +1774,24 @@ class GeminiItem():
         else:
             print("ERROR : NO CACHE in cache_last_modified")
             return None
+
+    def cache_digest(self):
+        # SHA-256 of the cached body, as it was received
+        path = self.get_cache_path()
+        if not path or not os.path.isfile(path):
+            return None
+        entry = self.cache_entry()
+        if entry and entry["sha256"]:
+            return entry["sha256"]
+        digest = hashlib.sha256()
+        with open_cache(path) as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        if entry:
+            cache_index().update(self.url, sha256=digest.hexdigest())
+        else:
+            self.index_cache(sha256=digest.hexdigest())
+        return digest.hexdigest()
     
     def get_body(self,as_file=False):
         if self.body and not as_file:
@@ -1538,6 +1806,24 @@ class GeminiItem():
                 toreturn = "Path is too long. This is an OS limitation.\n\n"
                 toreturn += self.url
                 return toreturn
+            elif is_compressed_cache(path):
+                copy = _UNCOMPRESSED_COPIES.get(path)
+                if as_file and copy and os.path.exists(copy) \
+                        and os.path.getmtime(copy) >= os.path.getmtime(path):
+                    return copy
+                with gzip.open(path) as f:
+                    body = f.read()
+                if as_file:
+                    # External tools expect an uncompressed file
+                    if copy and os.path.exists(copy):
+                        os.remove(copy)
+                    suffix = os.path.splitext(path)[1]
+                    tmpf = tempfile.NamedTemporaryFile("wb",suffix=suffix,delete=False)
+                    tmpf.write(body)
+                    tmpf.close()
+                    _UNCOMPRESSED_COPIES[path] = tmpf.name
+                    return tmpf.name
+                return body.decode("UTF-8")
             elif as_file:
                 return path
             else:
@@ -1695,8 +1981,10 @@ class GeminiItem():
         self.body = body
         self.mime, options = parse_mime(mime)
         if not self.local:
+            compress = False
             if self.mime and self.mime.startswith("text/"):
                 mode = "w"
+                compress = _COMPRESS_CACHE and isinstance(body,str)
             else:
                 mode = "wb"
             cache_dir = os.path.dirname(self.get_cache_path())
@@ -1713,9 +2001,29 @@ class GeminiItem():
             if os.path.isfile(root_dir):
                 os.remove(root_dir)
             os.makedirs(cache_dir,exist_ok=True)
-            with open(self.get_cache_path(), mode=mode) as f:
-                f.write(body)
-                f.close()
+            if compress:
+                with open(self.get_cache_path(), mode="wb") as f:
+                    with gzip.GzipFile(filename=_GZIP_NAME,mode="wb",fileobj=f) as gz:
+                        gz.write(body.encode("UTF-8"))
+            elif hasattr(body,"read"):
+                # body is a file (RRTP resources are received on disk):
+                # it is copied by chunks instead of being loaded in memory
+                with open(self.get_cache_path(), mode="wb") as f:
+                    shutil.copyfileobj(body,f)
+                body.close()
+                self.body = None
+            else:
+                with open(self.get_cache_path(), mode=mode) as f:
+                    f.write(body)
+                    f.close()
+            self.index_cache(mime=self.mime, charset=options.get("charset"), status="ok")
+
+    def index_cache(self, **fields):
+        # A new index entry for our current cache
+        index = cache_index()
+        st = self.cache_stat()
+        if index and st and not self.local and stat.S_ISREG(st.st_mode):
+            index.put(self.url, st, **fields)
          
     def get_mime(self):
         #Beware, this one is really a shaddy ad-hoc function
@@ -1723,14 +2031,29 @@ class GeminiItem():
             return self.mime
         elif self.is_cache_valid():
             path = self.get_cache_path()
+            entry = self.cache_entry()
+            mime2 = None
             if self.scheme == "mailto":
                 mime = "mailto"
             elif os.path.isdir(path):
                 mime = "Local Folder"
             elif path.endswith(".gmi"):
                 mime = "text/gemini"
+            elif entry and entry["mime"]:
+                # given by the server or already guessed, it goes through
+                # the same choice of renderer as what "file" says
+                mime = entry["mime"]
+                if "xhtml" in mime:
+                    mime = "text/html"
+                #Feeds are text/xml so the FeedRenderer fallback to html
+                elif mime.startswith("application/") and mime.endswith("xml"):
+                    mime = "text/xml"
             elif shutil.which("file") :
-                mime = run("file -b --mime-type %s", parameter=path).strip()
+                if is_compressed_cache(path):
+                    # -z looks at the content of the compressed file
+                    mime = run("file -bz --mime-type %s", parameter=path).strip()
+                else:
+                    mime = run("file -b --mime-type %s", parameter=path).strip()
                 mime2,encoding = mimetypes.guess_type(path,strict=False)
                 #If we hesitate between html and xml, takes the xml one
                 #because the FeedRendered fallback to HtmlRenderer
@@ -1749,21 +2072,39 @@ class GeminiItem():
                 print("Cannot guess the mime type of the file. Please install \"file\".")
                 print("(and send me an email, I’m curious of systems without \"file\" installed!")
             if mime.startswith("text") and mime not in _FORMAT_RENDERERS:
+                if not mime2:
+                    mime2,encoding = mimetypes.guess_type(path,strict=False)
                 if mime2 and mime2 in _FORMAT_RENDERERS:
                     mime = mime2
                 else:
                     #by default, we consider it’s gemini except for html
                     mime = "text/gemini"
             self.mime = mime
+            if not entry:
+                self.index_cache(mime=mime)
+            elif mime != entry["mime"]:
+                cache_index().update(self.url, mime=mime)
         return self.mime
     
+    def expected_mime(self):
+        # Guess the mime before fetching: gopher item types are known from
+        # the URL, then we trust a previous cache, then the URL extension.
+        if self.mime:
+            return self.mime
+        elif self.is_cache_valid():
+            return self.get_mime()
+        elif not self.local:
+            mime,encoding = mimetypes.guess_type(self.path,strict=False)
+            return mime
+        return None
+
     def set_error(self,err):
     # If we get an error, we want to keep an existing cache
     # but we need to touch it or to create an empty one
     # to avoid hitting the error at each refresh
         cache = self.get_cache_path()
         if self.is_cache_valid():
-            os.utime(cache)
+            self.touch_cache()
         else:
             cache_dir = os.path.dirname(cache)
             root_dir = cache_dir
@@ -1783,6 +2124,7 @@ class GeminiItem():
                     cache.write("If you believe this error was temporary, type ""reload"".\n")
                     cache.write("The ressource will be tentatively fetched during next sync.\n")
                     cache.close()
+                self.index_cache(status="error")
     
                
     def root(self):
@@ -1885,9 +2227,249 @@ def looks_like_base64(src,baseurl):
         imgurl = urllib.parse.urljoin(baseurl, imgname)
     return imgurl,imgdata
 
+# Happy Eyeballs (RFC 8305): addresses are tried in parallel, a new attempt
+# being started every _CONNECT_ATTEMPT_DELAY seconds (or as soon as the
+# previous one failed). The first socket to connect is returned, the others
+# are closed. Address families are interleaved so that an unreachable IPv6
+# network doesn’t delay the IPv4 attempts.
+def interleave_addresses(addresses):
+    families = {}
+    for address in addresses:
+        families.setdefault(address[0],[]).append(address)
+    queues = list(families.values())
+    ordered = []
+    while queues:
+        for q in list(queues):
+            ordered.append(q.pop(0))
+            if not q:
+                queues.remove(q)
+    return ordered
+
+def race_connect(addresses,timeout,delay=_CONNECT_ATTEMPT_DELAY,debug=None):
+    """Connect to the first reachable address of a getaddrinfo() list.
+    Returns the address and the connected socket (in blocking mode, with
+    timeout set). Raises the last error if no address could be reached."""
+    pending = interleave_addresses(addresses)
+    attempts = {}
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+    next_attempt = time.monotonic()
+    err = None
+    winner = None
+    timed_out = False
+    try:
+        while (pending or attempts) and not winner:
+            now = time.monotonic()
+            if now >= deadline:
+                timed_out = True
+                break
+            if pending and (now >= next_attempt or not attempts):
+                address = pending.pop(0)
+                if debug:
+                    debug("Connecting to: " + str(address[4]))
+                s = socket.socket(address[0], address[1], address[2])
+                s.setblocking(False)
+                code = s.connect_ex(address[4])
+                if code == 0:
+                    winner = address, s
+                    break
+                elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                    attempts[s] = address
+                    selector.register(s, selectors.EVENT_WRITE)
+                    next_attempt = now + delay
+                else:
+                    s.close()
+                    err = OSError(code, os.strerror(code))
+                    next_attempt = now
+                continue
+            if pending:
+                wait = min(next_attempt, deadline) - now
+            else:
+                wait = deadline - now
+            for key, events in selector.select(max(wait,0)):
+                s = key.fileobj
+                address = attempts.pop(s)
+                selector.unregister(s)
+                code = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    winner = address, s
+                    break
+                s.close()
+                err = OSError(code, os.strerror(code))
+                # A failed attempt immediately gives its turn to the next one
+                next_attempt = time.monotonic()
+    finally:
+        for s in attempts:
+            s.close()
+        selector.close()
+    if not winner:
+        # If we couldn't connect to *any* of the addresses, just
+        # bubble up the exception from the last attempt and deny
+        # knowledge of earlier failures.
+        if err and not timed_out:
+            raise err
+        raise socket.timeout("Could not connect to any address in %s seconds"%timeout)
+    address, s = winner
+    s.setblocking(True)
+    s.settimeout(timeout)
+    return address, s
+
 class UserAbortException(Exception):
     pass
 
+class FetchArchive():
+    # Records the fetches of a session in a SQLite file (--record) and
+    # serves them back instead of the network (--replay), taking as long
+    # as they originally did or, with realtime=False, at full speed.
+    # A fetcher returning a GeminiItem is recorded by what it cached,
+    # _send_request by the raw gemini reply (status and meta included),
+    # failures by their exception. Fetchers of several items at once
+    # (MANY_FETCHERS) are recorded item by item, the time they took being
+    # on the first one.
+    FETCHERS = ("_fetch_http", "_fetch_gopher", "_fetch_finger", "_fetch_spartan",
+                "_send_request", "_fetch_rrtp", "_fetch_from_gateway")
+    MANY_FETCHERS = ("_fetch_rrtp_many",)
+
+    def __init__(self, path, replay=False, realtime=True):
+        self.replay = replay
+        self.realtime = realtime
+        self.conn = sqlite3.connect(path)
+        self.cur = self.conn.cursor()
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS fetches
+            (id integer PRIMARY KEY, fetcher text, url text, started real,
+            duration real, result_url text, mime text, address text,
+            body blob, error_type text, error text)""")
+        self.conn.commit()
+        # last fetch replayed, by (fetcher, url)
+        self.replayed = {}
+
+    def wrap(self, name, fetcher):
+        def fetch(gi, *args, **kwargs):
+            if self.replay:
+                return self.replay_fetch(name, gi)
+            return self.record_fetch(name, fetcher, gi, *args, **kwargs)
+        return fetch
+
+    def wrap_many(self, name, fetcher):
+        def fetch(gitems, *args, **kwargs):
+            if self.replay:
+                fetched = [self.replay_fetch(name, gi) for gi in gitems]
+                return [gi for gi in fetched if gi]
+            return self.record_many(name, fetcher, gitems, *args, **kwargs)
+        return fetch
+
+    def record_fetch(self, name, fetcher, gi, *args, **kwargs):
+        started = time.time()
+        result = err = None
+        try:
+            result = fetcher(gi, *args, **kwargs)
+        except UserAbortException:
+            raise
+        except Exception as e:
+            err = e
+            raise
+        else:
+            if name == "_send_request":
+                address, f = result
+                with f:
+                    result = address, io.BytesIO(f.read())
+            return result
+        finally:
+            self.save(name, gi.url, started, time.time() - started, result, err)
+            self.conn.commit()
+
+    def record_many(self, name, fetcher, gitems, *args, **kwargs):
+        started = time.time()
+        fetched = err = None
+        try:
+            fetched = fetcher(gitems, *args, **kwargs)
+        except UserAbortException:
+            raise
+        except Exception as e:
+            err = e
+            raise
+        else:
+            return fetched
+        finally:
+            duration = time.time() - started
+            results = {gi.url: gi for gi in fetched or []}
+            for gi in gitems:
+                self.save(name, gi.url, started, duration, results.get(gi.url), err)
+                duration = 0
+            self.conn.commit()
+
+    def save(self, name, url, started, duration, result=None, err=None):
+        result_url = mime = address = body = error_type = error = None
+        if err:
+            error_type, error = exception_name(type(err)), str(err)
+        elif name == "_send_request" and result:
+            address, f = result
+            body = f.getvalue()
+            address = json.dumps(address)
+        elif result:
+            result_url, mime = result.url, result.mime
+            path = result.get_cache_path()
+            if path and os.path.isfile(path):
+                with open_cache(path) as f:
+                    body = f.read()
+        self.cur.execute("""INSERT INTO fetches (fetcher, url, started, duration,
+            result_url, mime, address, body, error_type, error)
+            VALUES (?,?,?,?,?,?,?,?,?,?)""", (name, url, started,
+            duration, result_url, mime, address, body, error_type, error))
+
+    def replay_fetch(self, name, gi):
+        # The fetches of a same URL are replayed in order, the last one
+        # again once they are exhausted
+        last = self.replayed.get((name, gi.url), 0)
+        self.cur.execute("""SELECT id, duration, result_url, mime, address, body,
+            error_type, error FROM fetches WHERE fetcher = ? AND url = ? AND id > ?
+            ORDER BY id LIMIT 1""", (name, gi.url, last))
+        row = self.cur.fetchone()
+        if not row:
+            self.cur.execute("""SELECT id, duration, result_url, mime, address, body,
+                error_type, error FROM fetches WHERE fetcher = ? AND url = ?
+                ORDER BY id DESC LIMIT 1""", (name, gi.url))
+            row = self.cur.fetchone()
+        if not row:
+            raise RuntimeError("%s is not in the archive" % gi.url)
+        fetch_id, duration, result_url, mime, address, body, error_type, error = row
+        self.replayed[(name, gi.url)] = fetch_id
+        if self.realtime:
+            time.sleep(duration)
+        if error_type:
+            raise self.exception(error_type, error)
+        if name == "_send_request":
+            family, socktype, proto, canonname, sockaddr = json.loads(address)
+            return (family, socktype, proto, canonname, tuple(sockaddr)), io.BytesIO(body)
+        if not result_url:
+            return None
+        result = gi if result_url == gi.url else GeminiItem(result_url)
+        body = body or b""
+        if mime:
+            # the cache holds text as UTF-8
+            body = decode_body(body, mime)
+        result.write_body(body, mime)
+        return result
+
+    def exception(self, error_type, error):
+        # The same exception as recorded when we know it
+        known = [socket.gaierror, ssl.SSLError, CertificateError]
+        if _DO_HTTP:
+            known += [requests.exceptions.ConnectionError, requests.exceptions.Timeout]
+        if _DO_RRTP:
+            known += [RRTPError, RRTPTimeout, RRTPLinkClosed, RRTPUnreachable]
+        for exception in known:
+            if exception_name(exception) == error_type:
+                return exception(error)
+        module, name = error_type.rsplit(".", 1)
+        exception = getattr(builtins, name, None)
+        if module == "builtins" and isinstance(exception, type) and issubclass(exception, Exception):
+            return exception(error)
+        return RuntimeError(error)
+
+def exception_name(exception):
+    return exception.__module__ + "." + exception.__qualname__
+
 # GeminiClient Decorators
 def needs_gi(inner):
     def outer(self, *args, **kwargs):
@@ -1920,13 +2502,17 @@ class GeminiClient(cmd.Cmd):
         self.index_index = -1
         self.marks = {}
         self.page_index = 0
-        self.permanent_redirects = {}
         self.previous_redirectors = set()
+        self.dns_cache = {}
         # Sync-only mode is restriced by design
         self.visited_hosts = set()
         self.offline_only = False
         self.sync_only = False
         self.support_http = _DO_HTTP
+        # Reticulum is only started the first time a rrtp:// URL is fetched
+        self.rrtp_client = None
+        # A "rrtp_gateway" which failed once is not asked anymore
+        self.gateway_failed = False
         self.automatic_choice = "n"
 
         self.client_certs = {
@@ -1948,9 +2534,20 @@ class GeminiClient(cmd.Cmd):
             "archives_size" : 200,
             "history_size" : 200,
             "max_size_download" : 10,
+            "sync_profile" : "full",
+            "redirect_ttl" : 0,
+            "rewrite_redirected_links" : False,
+            "rrtp_idle_timeout" : 300,
+            "rrtp_max_links" : 8,
+            "rns_config" : None,
+            "rrtp_identify" : False,
+            "rrtp_serve_allow" : "",
+            "rrtp_serve_rate" : 60,
+            "rrtp_gateway" : None,
             "editor" : None,
             "download_images_first" : True,
             "redirects" : True,
+            "cache_compression" : False,
             # the wikipedia entry needs two %s, one for lang, other for search
             "wikipedia" : "gemini://vault.transjovian.org:1965/search/%s/%s",
             "search"    : "gemini://kennedy.gemi.dev/search?%s",
@@ -1978,6 +2575,9 @@ class GeminiClient(cmd.Cmd):
             "ipv4_bytes_recvd": 0,
             "ipv6_bytes_recvd": 0,
             "dns_failures": 0,
+            "rrtp_failures": 0,
+            "rrtp_requests": 0,
+            "rrtp_bytes_recvd": 0,
             "refused_connections": 0,
             "reset_connections": 0,
             "timeouts": 0,
@@ -1985,6 +2585,7 @@ class GeminiClient(cmd.Cmd):
         }
 
         self._connect_to_tofu_db()
+        self._connect_to_redirects_db()
 
     def complete_list(self,text,line,begidx,endidx):
         allowed = []
@@ -2025,6 +2626,16 @@ class GeminiClient(cmd.Cmd):
     def complete_move(self,text,line,begidx,endidx):
         return self.complete_add(text,line,begidx,endidx)
 
+    def use_archive(self, archive):
+        # Every network fetch goes through the FetchArchive
+        for name in FetchArchive.FETCHERS:
+            setattr(self, name, archive.wrap(name, getattr(self, name)))
+        for name in FetchArchive.MANY_FETCHERS:
+            setattr(self, name, archive.wrap_many(name, getattr(self, name)))
+        if archive.replay:
+            # Paths only make the fetches faster, there is nothing to ask
+            self._request_rrtp_paths = lambda lists, validity=0: None
+
     def _connect_to_tofu_db(self):
 
         db_path = os.path.join(_CONFIG_DIR, "tofu.db")
@@ -2035,8 +2646,75 @@ class GeminiClient(cmd.Cmd):
             (hostname text, address text, fingerprint text,
             first_seen date, last_seen date, count integer)""")
 
+    def _connect_to_redirects_db(self):
+        # Redirections seen while fetching are kept across sessions
+        # so we don’t pay the redirect round-trip at every sync
+        db_path = os.path.join(_DATA_DIR, "redirects.db")
+        self.redirects_conn = sqlite3.connect(db_path)
+        self.redirects_cur = self.redirects_conn.cursor()
+
+        self.redirects_cur.execute("""CREATE TABLE IF NOT EXISTS redirects
+            (url text PRIMARY KEY, target text, permanent integer,
+            recorded date, expires real)""")
+
+    def _record_redirect(self, url, target, permanent=True):
+        if not url or not target or url == target:
+            return
+        now = time.time()
+        if permanent:
+            expires = None
+        elif float(self.options["redirect_ttl"]) <= 0:
+            # Temporary targets (signed or download URLs…) may not last
+            return
+        else:
+            expires = now + float(self.options["redirect_ttl"])
+        # A recorded chain leading from target back to url (a move being
+        # reverted) would make a loop: its last hop is forgotten
+        hop = target
+        seen = set([url])
+        while hop not in seen:
+            seen.add(hop)
+            self.redirects_cur.execute("SELECT target FROM redirects WHERE url=?", (hop,))
+            row = self.redirects_cur.fetchone()
+            if not row:
+                break
+            if row[0] == url:
+                self.redirects_cur.execute("DELETE FROM redirects WHERE url=?", (hop,))
+                break
+            hop = row[0]
+        self.redirects_cur.execute("""INSERT OR REPLACE INTO redirects
+            VALUES (?, ?, ?, ?, ?)""",
+            (url, target, int(permanent), datetime.datetime.now(), expires))
+        self.redirects_conn.commit()
+
+    def _get_redirect(self, url, permanent_only=False):
+        """Follow the recorded redirections of url.
+        Returns the final URL or None if url was never redirected."""
+        now = time.time()
+        target = url
+        seen = set([url])
+        while len(seen) <= _MAX_REDIRECTS:
+            self.redirects_cur.execute("""SELECT target, permanent, expires
+                FROM redirects WHERE url=?""", (target,))
+            row = self.redirects_cur.fetchone()
+            if not row:
+                break
+            new_target, permanent, expires = row
+            if expires and expires < now:
+                self.redirects_cur.execute("DELETE FROM redirects WHERE url=?", (target,))
+                self.redirects_conn.commit()
+                break
+            if (permanent_only and not permanent) or new_target in seen:
+                break
+            seen.add(new_target)
+            target = new_target
+        if target == url:
+            return None
+        return target
+
     def _go_to_gi(self, gi, update_hist=True, check_cache=True, handle=True,\
-                                                mode=None,limit_size=False):
+                                                mode=None,limit_size=False,max_size=None,\
+                                                follow_redirects=True):
         """This method might be considered "the heart of Offpunk".
         Everything involved in fetching a gemini resource happens here:
         sending the request over the network, parsing the response, 
@@ -2064,10 +2742,20 @@ class GeminiClient(cmd.Cmd):
 
         if not mode:
             mode = gi.last_mode
-        # Obey permanent redirects
-        if gi.url in self.permanent_redirects:
-            new_gi = GeminiItem(self.permanent_redirects[gi.url], name=gi.name)
-            self._go_to_gi(new_gi,mode=mode)
+        # Obey redirects recorded in previous fetches, unless offline
+        # without the target: the page is then read from our own cache.
+        # The target itself is not redirected again.
+        redirect = None
+        if follow_redirects:
+            redirect = self._get_redirect(gi.url)
+        if redirect and self.offline_only and not GeminiItem(redirect).is_cache_valid():
+            redirect = None
+        if redirect:
+            new_gi = GeminiItem(redirect, name=gi.name)
+            self._debug("Following recorded redirect to %s." % new_gi.url)
+            self._go_to_gi(new_gi,update_hist=update_hist,check_cache=check_cache,\
+                            handle=handle,mode=mode,limit_size=limit_size,max_size=max_size,\
+                            follow_redirects=False)
             return
         
         # Use cache or mark as to_fetch if resource is not cached
@@ -2087,14 +2775,34 @@ class GeminiClient(cmd.Cmd):
             return
 
         elif not self.offline_only and not gi.local:
+            if limit_size:
+                # Let’s cap automatic downloads to 20Mo
+                max_download = int(self.options["max_size_download"])*1000000
+                # and to what is left from the sync binary budget
+                if max_size is not None:
+                    max_download = min(max_download,max_size)
+            else:
+                max_download = None
             try:
-                if gi.scheme in ("http", "https"):
+                fetched = None
+                if self.options["rrtp_gateway"] and gi.scheme in _GATEWAY_SCHEMES \
+                                                    and not self.gateway_failed:
+                    try:
+                        fetched = self._fetch_from_gateway(gi,max_length=max_download)
+                    except RRTPUnreachable as err:
+                        # Without path (or still in backoff), every fetch would wait
+                        # for it: URLs are fetched directly for the rest of the session
+                        self._debug("Gateway %s unreachable, not used anymore: %s"\
+                                        %(self.options["rrtp_gateway"],err))
+                        self.gateway_failed = True
+                    except RRTPError as err:
+                        # (too large, too slow…) only this URL is fetched directly
+                        self._debug("Gateway %s failed for %s: %s"\
+                                        %(self.options["rrtp_gateway"],gi.url,err))
+                if fetched:
+                    gi = fetched
+                elif gi.scheme in ("http", "https"):
                     if self.support_http:
-                        if limit_size:
-                            # Let’s cap automatic downloads to 20Mo
-                            max_download = int(self.options["max_size_download"])*1000000
-                        else:
-                            max_download = None
                         gi = self._fetch_http(gi,max_length=max_download)
                     elif handle and not self.sync_only:
                         if not _DO_HTTP:
@@ -2104,15 +2812,19 @@ class GeminiClient(cmd.Cmd):
                     else:
                         return
                 elif gi.scheme in ("gopher"):
-                    gi = self._fetch_gopher(gi,timeout=self.options["short_timeout"])
+                    gi = self._fetch_gopher(gi,max_length=max_download)
                 elif gi.scheme in ("finger"):
-                    gi = self._fetch_finger(gi,timeout=self.options["short_timeout"])
+                    gi = self._fetch_finger(gi,max_length=max_download)
                 elif gi.scheme in ("spartan"):
-                    gi = self._fetch_spartan(gi)
+                    gi = self._fetch_spartan(gi,max_length=max_download)
                 elif gi.scheme in ("rrtp"):
-                    gi = self._fetch_rrtp(gi)
+                    if not _DO_RRTP:
+                        if handle and not self.sync_only:
+                            print("Install python3-rns (Reticulum) to access rrtp:// links")
+                        return
+                    gi = self._fetch_rrtp(gi,max_length=max_download)
                 else:
-                    gi = self._fetch_over_network(gi)
+                    gi = self._fetch_over_network(gi,max_length=max_download)
             except UserAbortException:
                 return
             except Exception as err:
@@ -2124,6 +2836,19 @@ class GeminiClient(cmd.Cmd):
                     self.log["dns_failures"] += 1
                     if print_error:
                         print("ERROR: DNS error!")
+                elif _DO_RRTP and isinstance(err, RRTPError):
+                    # The link is already dropped from the pool: the next
+                    # request to this node will establish a new one.
+                    self.log["rrtp_failures"] += 1
+                    if print_error:
+                        if isinstance(err, RRTPUnreachable):
+                            print("ERROR10: RRTP node unreachable: %s" %err)
+                        elif isinstance(err, RRTPTimeout):
+                            print("ERROR7: RRTP node did not answer in time: %s" %err)
+                        elif isinstance(err, RRTPLinkClosed):
+                            print("ERROR8: RRTP link closed: %s" %err)
+                        else:
+                            print("ERROR9: RRTP: %s" %err)
                 elif isinstance(err, ConnectionRefusedError):
                     self.log["refused_connections"] += 1
                     if print_error:
@@ -2186,15 +2911,17 @@ class GeminiClient(cmd.Cmd):
                     print("Handler program %s not found!" % shlex.split(cmd_str)[0])
                     print("You can use the ! command to specify another handler program or pipeline.")
 
+    def _set_size_error(self,item,length,max_length):
+        err = "Size of %s is %s Mo\n"%(item.url,length)
+        err += "Offpunk only download automatically content under %s Mo\n" %(max_length/1000000)
+        err += "To retrieve this content anyway, type 'reload'." 
+        item.set_error(err)
+        return item
+
     def _fetch_http(self,gi,max_length=None):
-        def set_error(item,length,max_length):
-            err = "Size of %s is %s Mo\n"%(item.url,length)
-            err += "Offpunk only download automatically content under %s Mo\n" %(max_length/1000000)
-            err += "To retrieve this content anyway, type 'reload'." 
-            item.set_error(err)
-            return item
         header = {}
         header["User-Agent"] = "Offpunk browser v%s"%_VERSION
+        header["Accept-Encoding"] = _HTTP_ENCODINGS
         parsed = urllib.parse.urlparse(gi.url)
         # Code to translate URLs to better frontends (think twitter.com -> nitter)
         if self.options["redirects"]:
@@ -2211,6 +2938,10 @@ class GeminiClient(cmd.Cmd):
                     parsed = parsed._replace(netloc = self.redirects[netloc])
         url = urllib.parse.urlunparse(parsed)
         with requests.get(url,headers=header, stream=True,timeout=5) as response:
+            # Remember the redirections followed by requests
+            hops = [r.url for r in response.history] + [response.url]
+            for i,r in enumerate(response.history):
+                self._record_redirect(hops[i], hops[i+1], permanent=r.status_code in (301,308))
             #print("This is header for %s"%gi.url)
             #print(response.headers)
             if "content-type" in response.headers:
@@ -2223,15 +2954,15 @@ class GeminiClient(cmd.Cmd):
                 length = 0
             if max_length and length > max_length:
                 response.close()
-                return set_error(gi,str(length/1000000),max_length)
+                return self._set_size_error(gi,str(length/1000000),max_length)
             elif max_length and length == 0:
-                body = b''
+                body = bytearray()
                 downloaded = 0
-                for r in response.iter_content():
+                for r in response.iter_content(chunk_size=65536):
                     body += r
                     #We divide max_size for streamed content
                     #in order to catch them faster
-                    size = sys.getsizeof(body)
+                    size = len(body)
                     max = max_length/2
                     current = round(size*100/max,0)
                     if current > downloaded:
@@ -2240,17 +2971,33 @@ class GeminiClient(cmd.Cmd):
                     #print("size: %s (%s\% of maxlenght)"%(size,size/max_length))
                     if size > max_length/2:
                         response.close()
-                        return set_error(gi,"streaming",max_length)
+                        return self._set_size_error(gi,"streaming",max_length)
+                response.close()
+                body = bytes(body)
+            elif max_length:
+                # content-length is the compressed size: the decompressed
+                # body is capped as it comes
+                body = bytearray()
+                for r in response.iter_content(chunk_size=65536):
+                    body += r
+                    if len(body) > max_length:
+                        response.close()
+                        return self._set_size_error(gi,"over %s"%(max_length/1000000),\
+                                                        max_length)
                 response.close()
+                body = bytes(body)
             else:
                 body = response.content
                 response.close()
         if mime and "text/" in mime:
             body = body.decode("UTF-8","replace")
         gi.write_body(body,mime)
+        # Visits following the recorded redirect find it in the cache
+        if len(hops) > 1 and hops[-1] != gi.url:
+            GeminiItem(hops[-1]).write_body(body,mime)
         return gi
 
-    def _fetch_gopher(self,gi,timeout=10):
+    def _fetch_gopher(self,gi,max_length=None):
         if not looks_like_url(gi.url):
             print("%s is not a valide url" %gi.url)
         parsed =urllib.parse.urlparse(gi.url)
@@ -2268,29 +3015,19 @@ class GeminiClient(cmd.Cmd):
         else:
             itemtype = "1"
             selector = parsed.path
-        addresses = socket.getaddrinfo(host, port, family=0,type=socket.SOCK_STREAM)
-        s = socket.create_connection((host,port))
-        for address in addresses:
-            self._debug("Connecting to: " + str(address[4]))
-            s = socket.socket(address[0], address[1])
-            s.settimeout(timeout)
-            try:
-                s.connect(address[4])
-                break
-            except OSError as e:
-                err = e
-        else:
-            # If we couldn't connect to *any* of the addresses, just
-            # bubble up the exception from the last attempt and deny
-            # knowledge of earlier failures.
-            raise err
         if parsed.query:
             request = selector + "\t" + parsed.query
         else:
             request = selector
         request += "\r\n"
-        s.sendall(request.encode("UTF-8"))
-        response = s.makefile("rb").read()
+        address, s = self._open_connection(host, port)
+        with s:
+            s.sendall(request.encode("UTF-8"))
+            response = read_limited(s.makefile("rb"),max_length)
+        if response is None:
+            self._log_visit(gi, address, max_length)
+            return self._set_size_error(gi,"over %s"%(max_length/1000000),max_length)
+        self._log_visit(gi, address, len(response))
         # Transcode response into UTF-8
         #if itemtype in ("0","1","h"):
         if not itemtype in ("9","g","I","s"):
@@ -2322,22 +3059,26 @@ class GeminiClient(cmd.Cmd):
         gi.write_body(response,mime)
         return gi
 
-    def _fetch_finger(self,gi,timeout=10):
+    def _fetch_finger(self,gi,max_length=None):
         if not looks_like_url(gi.url):
             print("%s is not a valid url" %gi.url)
         parsed = urllib.parse.urlparse(gi.url)
         host = parsed.hostname
         port = parsed.port or standard_ports["finger"]
         query = parsed.path.lstrip("/") + "\r\n"
-        with socket.create_connection((host,port)) as sock:
-            sock.settimeout(timeout)
-            sock.send(query.encode())
-            response = sock.makefile("rb").read().decode("UTF-8")
-            gi.write_body(response,"text/plain")
+        address, sock = self._open_connection(host, port)
+        with sock:
+            sock.sendall(query.encode())
+            response = read_limited(sock.makefile("rb"),max_length)
+        if response is None:
+            self._log_visit(gi, address, max_length)
+            return self._set_size_error(gi,"over %s"%(max_length/1000000),max_length)
+        self._log_visit(gi, address, len(response))
+        gi.write_body(response.decode("UTF-8"),"text/plain")
         return gi
 
     # Copied from reference spartan client by Michael Lazar
-    def _fetch_spartan(self,gi):
+    def _fetch_spartan(self,gi,max_length=None):
         url_parts = urllib.parse.urlparse(gi.url)
         host = url_parts.hostname
         port = url_parts.port or 300
@@ -2346,7 +3087,8 @@ class GeminiClient(cmd.Cmd):
 
         redirect_url = None
 
-        with socket.create_connection((host,port)) as sock:
+        address, sock = self._open_connection(host, port)
+        with sock:
             if query:
                 data = urllib.parse.unquote_to_bytes(query)
             else:
@@ -2354,34 +3096,230 @@ class GeminiClient(cmd.Cmd):
             encoded_host = host.encode("idna")
             ascii_path = urllib.parse.unquote_to_bytes(path)
             encoded_path = urllib.parse.quote_from_bytes(ascii_path).encode("ascii")
-            sock.send(b"%s %s %d\r\n" % (encoded_host,encoded_path,len(data)))
+            sock.sendall(b"%s %s %d\r\n" % (encoded_host,encoded_path,len(data)) + data)
             fp = sock.makefile("rb")
-            response = fp.readline(4096).decode("ascii").strip("\r\n")
+            response = fp.readline(4096)
+            size = len(response)
+            response = response.decode("ascii").strip("\r\n")
             parts = response.split(" ",maxsplit=1)
             code,meta = int(parts[0]),parts[1]
             if code == 2:
-                body = fp.read()
-                if meta.startswith("text"):
-                    body = body.decode("UTF-8")
-                gi.write_body(body,meta)
+                body = read_limited(fp,max_length)
+                if body is None:
+                    size += max_length
+                    self._set_size_error(gi,"over %s"%(max_length/1000000),max_length)
+                else:
+                    size += len(body)
+                    if meta.startswith("text"):
+                        body = body.decode("UTF-8")
+                    gi.write_body(body,meta)
             elif code == 3:
                 redirect_url = url_parts._replace(path=meta).geturl()
             else:
                 gi.set_error("Spartan code %s: Error %s"%(code,meta))
+        self._log_visit(gi, address, size)
         if redirect_url:
             gi = GeminiItem(redirect_url)
-            self._fetch_spartan(gi)
+            self._fetch_spartan(gi,max_length=max_length)
+        return gi
+
+    def _get_rrtp_client(self):
+        # One client (and one Reticulum instance) for the whole process,
+        # with an identity persisted in the config directory
+        if not self.rrtp_client:
+            identity = load_identity(os.path.join(_CONFIG_DIR, "rrtp_identity"))
+            # An already running rnsd (sharing its instance) is used when
+            # found, else Reticulum and its interfaces are started here.
+            self.rrtp_client = RRTPRequest(identity=identity,
+                                link_idle_timeout=self.options["rrtp_idle_timeout"],
+                                max_links=self.options["rrtp_max_links"],
+                                configdir=self.options["rns_config"],
+                                identify=self.options["rrtp_identify"])
+            if self.rrtp_client.reticulum.is_connected_to_shared_instance:
+                self._debug("Attached to the shared Reticulum instance")
+            else:
+                self._debug("No shared Reticulum instance found, started our own")
+            self._connect_to_rrtp_db()
+            self.rrtp_cur.execute("SELECT destination, failures, retry_after FROM unreachable")
+            for destination, failures, retry_after in self.rrtp_cur.fetchall():
+                self.rrtp_client.unreachable[bytes.fromhex(destination)] = (failures, retry_after)
+            self.rrtp_cur.execute("SELECT destination, public_key, hops, last_seen FROM destinations")
+            for destination, public_key, hops, last_seen in self.rrtp_cur.fetchall():
+                self.rrtp_client.known[bytes.fromhex(destination)] = (public_key, hops, last_seen)
+        return self.rrtp_client
+
+    def serve_rrtp(self):
+        # Peers can browse and sync our cache instead of the whole network.
+        # The server has its own identity: its address doesn't tell who
+        # we are when we browse.
+        identity = load_identity(os.path.join(_CONFIG_DIR, "rrtp_server_identity"))
+        allowed = None
+        if self.options["rrtp_serve_allow"]:
+            allowed = [bytes.fromhex(h) for h in self.options["rrtp_serve_allow"].split(",")]
+        server = CacheServer(_CACHE_PATH, identity=identity,
+                             configdir=self.options["rns_config"],
+                             allowed=allowed, rate=self.options["rrtp_serve_rate"])
+        print("Serving %s paths of the cache at %s" %(len(server.paths), server.url()))
+        if allowed:
+            print("Only to %s identities" %len(allowed))
+        server.serve_forever()
+
+    def _connect_to_rrtp_db(self):
+        # RRTP nodes not answering path requests are not asked again
+        # at every sync (see RRTPRequest.request_paths) and the identities
+        # of the nodes heard are kept to reach them without announce.
+        db_path = os.path.join(_DATA_DIR, "rrtp.db")
+        self.rrtp_conn = sqlite3.connect(db_path)
+        self.rrtp_cur = self.rrtp_conn.cursor()
+
+        self.rrtp_cur.execute("""CREATE TABLE IF NOT EXISTS unreachable
+            (destination text PRIMARY KEY, failures integer, retry_after real)""")
+        self.rrtp_cur.execute("""CREATE TABLE IF NOT EXISTS destinations
+            (destination text PRIMARY KEY, public_key blob, hops integer, last_seen real)""")
+
+    def _save_rrtp_state(self):
+        if not self.rrtp_client:
+            return
+        self.rrtp_cur.execute("DELETE FROM unreachable")
+        for destination, (failures, retry_after) in self.rrtp_client.unreachable.items():
+            self.rrtp_cur.execute("INSERT INTO unreachable VALUES (?, ?, ?)",
+                                    (destination.hex(), failures, retry_after))
+        for destination, (public_key, hops, last_seen) in list(self.rrtp_client.known.items()):
+            self.rrtp_cur.execute("INSERT OR REPLACE INTO destinations VALUES (?, ?, ?, ?)",
+                                    (destination.hex(), public_key, hops, last_seen))
+        self.rrtp_conn.commit()
+
+    def _request_rrtp_paths(self, lists, validity=0):
+        # Paths to all the RRTP nodes we will sync are requested at once
+        # instead of one after the other when each page is fetched.
+        urls = []
+        for l in lists:
+            for gitem in self.list_get_links(l):
+                if gitem.scheme == "rrtp" and not gitem.is_cache_valid(validity=validity):
+                    urls.append(gitem.url)
+        if urls:
+            requested = self._get_rrtp_client().request_paths(urls)
+            if requested:
+                print(" * * * Requesting paths to %s RRTP nodes * * *" %len(requested))
+
+    def _fetch_rrtp(self, gi, max_length=None):
+        # Large responses are transferred as RNS resources
+        def progress(fraction):
+            print("  -> Receiving stream: %s%%" %round(fraction*100),end='\r')
+        # If we already have it, the node can answer that it didn’t change
+        # instead of sending it again
+        # and its size tells how long the answer could take on slow links
+        digest = None
+        size = None
+        if gi.is_cache_valid():
+            digest = gi.cache_digest()
+            size = os.path.getsize(gi.get_cache_path())
+        r = self._get_rrtp_client().get(gi.url,max_size=max_length,progress=progress,\
+                                            sha256=digest,expected_size=size)
+        return self._handle_rrtp_response(gi, r, max_length=max_length)
+
+    def _handle_rrtp_response(self, gi, r, max_length=None):
+        # RRTP statuses are the Gemini ones, with the mime type always
+        # given and the meta after it.
+        # RRTP nodes are identified by their destination hash
+        self._log_visit(gi, ("rrtp", gi.host), r.size)
+        self._debug("Response header: %s %s %s" % (r.status, r.type, r.meta))
+        if not r.status.startswith("3"):
+            self.previous_redirectors = set()
+        # Inputs
+        if r.status.startswith("1"):
+            if self.sync_only:
+                return None
+            print(r.meta)
+            if r.status == "11":
+                user_input = getpass.getpass("> ")
+            else:
+                user_input = input("> ")
+            return self._fetch_rrtp(gi.query(user_input), max_length=max_length)
+        # Redirects
+        elif r.status.startswith("3"):
+            new_gi = GeminiItem(gi.absolutise_url(r.meta))
+            self._check_redirect(gi, new_gi, r.status)
+            if new_gi.scheme != "rrtp":
+                # it is recorded and will be followed by the next visit
+                raise RuntimeError("Redirected to %s" % new_gi.url)
+            return self._fetch_rrtp(new_gi, max_length=max_length)
+        # Errors
+        elif r.status == "44":
+            raise RuntimeError("Slow down: the node asks to wait %s seconds" % r.meta)
+        elif r.status.startswith("4") or r.status.startswith("5"):
+            raise RuntimeError(r.meta or "RRTP error %s" % r.status)
+        # RRTP nodes know us by our identity, not by certificates
+        elif r.status.startswith("6"):
+            raise RuntimeError("Client certificate requested: %s" % r.meta)
+        elif not r.ok:
+            raise RuntimeError("Server returned undefined status code %s!" % r.status)
+        elif r.status == NOT_MODIFIED:
+            # The cache is up to date, it is considered as freshly fetched
+            gi.touch_cache()
+            return gi
+        self._write_rrtp_body(gi, r)
         return gi
 
-    def _fetch_rrtp(self, gi):
-        request = RRTPRequest()
-        r = request.get(gi.url)
-        gi.write_body(r.body, r.header)
+    def _write_rrtp_body(self, gi, r):
+        mime = r.type or "text/gemini; charset=utf-8"
+        body = r.body if r.body is not None else b""
+        if hasattr(body, "read") and mime.startswith("text/"):
+            with body:
+                body = body.read()
+        # binaries, in memory or on disk, are written as received
+        gi.write_body(decode_body(body, mime), mime)
+
+    def _fetch_from_gateway(self, gi, max_length=None):
+        # A node of the mesh caching for the others may have a copy newer
+        # than ours: one uplink fetch serves everybody. Returns None when
+        # it hasn’t, the URL is then fetched as usual.
+        gateway = self.options["rrtp_gateway"]
+        since = None
+        if gi.is_cache_valid():
+            since = os.path.getmtime(gi.get_cache_path())
+        r = self._get_rrtp_client().get_through(gateway, gi.url, since=since,
+                                                max_size=max_length)
+        self._log_visit(gi, ("rrtp", gateway), r.size)
+        if r.status != "20":
+            self._debug("Gateway %s has no newer %s (%s)" % (gateway, gi.url, r.status))
+            return None
+        self._debug("Got %s from gateway %s" % (gi.url, gateway))
+        self._write_rrtp_body(gi, r)
+        # It is as fresh as when the gateway fetched it
+        try:
+            gi.touch_cache(float(r.meta))
+        except ValueError:
+            pass
         return gi
 
+    def _fetch_rrtp_many(self, gitems, max_length=None):
+        # All the pages are asked at once, in one exchange per node.
+        # Pages which could not be fetched are left as they were.
+        digests = {}
+        sizes = {}
+        for gi in gitems:
+            if gi.is_cache_valid():
+                digests[gi.url] = gi.cache_digest()
+                sizes[gi.url] = os.path.getsize(gi.get_cache_path())
+        urls = [gi.url for gi in gitems]
+        responses = self._get_rrtp_client().get_many(urls,sha256s=digests,max_size=max_length,\
+                                                        sizes=sizes)
+        fetched = []
+        for gi, r in zip(gitems, responses):
+            if isinstance(r, RRTPError):
+                continue
+            try:
+                result = self._handle_rrtp_response(gi, r, max_length=max_length)
+                if result:
+                    fetched.append(result)
+            except Exception as err:
+                gi.set_error(err)
+        return fetched
+
     # fetch_over_network will modify with gi.write_body(body,mime)
     # before returning the gi
-    def _fetch_over_network(self, gi):
+    def _fetch_over_network(self, gi, max_length=None):
         
         # Be careful with client certificates!
         # Are we crossing a domain boundary?
@@ -2449,40 +3387,13 @@ class GeminiClient(cmd.Cmd):
                     user_input = getpass.getpass("> ")
                 else:
                     user_input = input("> ")
-                return self._fetch_over_network(gi.query(user_input))
+                return self._fetch_over_network(gi.query(user_input), max_length=max_length)
 
         # Redirects
         elif status.startswith("3"):
             new_gi = GeminiItem(gi.absolutise_url(meta))
-            if new_gi.url == gi.url:
-                raise RuntimeError("URL redirects to itself!")
-            elif new_gi.url in self.previous_redirectors:
-                raise RuntimeError("Caught in redirect loop!")
-            elif len(self.previous_redirectors) == _MAX_REDIRECTS:
-                raise RuntimeError("Refusing to follow more than %d consecutive redirects!" % _MAX_REDIRECTS)
-            elif self.sync_only:
-                follow = self.automatic_choice
-            # Never follow cross-domain redirects without asking
-            elif new_gi.host != gi.host:
-                follow = input("Follow cross-domain redirect to %s? (y/n) " % new_gi.url)
-            # Never follow cross-protocol redirects without asking
-            elif new_gi.scheme != gi.scheme:
-                follow = input("Follow cross-protocol redirect to %s? (y/n) " % new_gi.url)
-            # Don't follow *any* redirect without asking if auto-follow is off
-            elif not self.options["auto_follow_redirects"]:
-                follow = input("Follow redirect to %s? (y/n) " % new_gi.url)
-            # Otherwise, follow away
-            else:
-                follow = "yes"
-            if follow.strip().lower() not in ("y", "yes"):
-                raise UserAbortException()
-            self._debug("Following redirect to %s." % new_gi.url)
-            self._debug("This is consecutive redirect number %d." % len(self.previous_redirectors))
-            self.previous_redirectors.add(gi.url)
-            if status == "31":
-                # Permanent redirect
-                self.permanent_redirects[gi.url] = new_gi.url
-            return self._fetch_over_network(new_gi)
+            self._check_redirect(gi, new_gi, status)
+            return self._fetch_over_network(new_gi, max_length=max_length)
 
         # Errors
         elif status.startswith("4") or status.startswith("5"):
@@ -2491,7 +3402,7 @@ class GeminiClient(cmd.Cmd):
         # Client cert
         elif status.startswith("6"):
             self._handle_cert_request(meta)
-            return self._fetch_over_network(gi)
+            return self._fetch_over_network(gi, max_length=max_length)
 
         # Invalid status
         elif not status.startswith("2"):
@@ -2502,29 +3413,50 @@ class GeminiClient(cmd.Cmd):
         
         mime = meta
         # Read the response body over the network
-        fbody = f.read()
+        fbody = read_limited(f, max_length)
+        f.close()
+        if fbody is None:
+            self._log_visit(gi, address, max_length)
+            return self._set_size_error(gi, "over %s" % (max_length/1000000), max_length)
+        self._log_visit(gi, address, len(fbody))
         # DEFAULT GEMINI MIME
         if mime == "":
             mime = "text/gemini; charset=utf-8"
-        shortmime, mime_options = parse_mime(mime)
-        if "charset" in mime_options:
-            try:
-                codecs.lookup(mime_options["charset"])
-            except LookupError:
-                raise RuntimeError("Header declared unknown encoding %s" % value)
-        if shortmime.startswith("text/"):
-            #Get the charset and default to UTF-8 in none
-            encoding = mime_options.get("charset", "UTF-8")
-            try:
-                body = fbody.decode(encoding)
-            except UnicodeError:
-                raise RuntimeError("Could not decode response body using %s\
-                                    encoding declared in header!" % encoding)
-        else:
-            body = fbody
+        body = decode_body(fbody, mime)
         gi.write_body(body,mime)    
         return gi
 
+    def _check_redirect(self, gi, new_gi, status):
+        """Asks, when needed, whether the redirect of gi to new_gi should be
+        followed (raising UserAbortException if not) and records it."""
+        if new_gi.url == gi.url:
+            raise RuntimeError("URL redirects to itself!")
+        elif new_gi.url in self.previous_redirectors:
+            raise RuntimeError("Caught in redirect loop!")
+        elif len(self.previous_redirectors) == _MAX_REDIRECTS:
+            raise RuntimeError("Refusing to follow more than %d consecutive redirects!" % _MAX_REDIRECTS)
+        elif self.sync_only:
+            follow = self.automatic_choice
+        # Never follow cross-domain redirects without asking
+        elif new_gi.host != gi.host:
+            follow = input("Follow cross-domain redirect to %s? (y/n) " % new_gi.url)
+        # Never follow cross-protocol redirects without asking
+        elif new_gi.scheme != gi.scheme:
+            follow = input("Follow cross-protocol redirect to %s? (y/n) " % new_gi.url)
+        # Don't follow *any* redirect without asking if auto-follow is off
+        elif not self.options["auto_follow_redirects"]:
+            follow = input("Follow redirect to %s? (y/n) " % new_gi.url)
+        # Otherwise, follow away
+        else:
+            follow = "yes"
+        if follow.strip().lower() not in ("y", "yes"):
+            raise UserAbortException()
+        self._debug("Following redirect to %s." % new_gi.url)
+        self._debug("This is consecutive redirect number %d." % len(self.previous_redirectors))
+        self.previous_redirectors.add(gi.url)
+        # 31 is a permanent redirect, 30 is only kept for redirect_ttl
+        self._record_redirect(gi.url, new_gi.url, permanent=status == "31")
+
     def _send_request(self, gi):
         """Send a selector to a given host and port.
         Returns the resolved address and binary file with the reply."""
@@ -2567,26 +3499,13 @@ class GeminiClient(cmd.Cmd):
             context.load_cert_chain(certfile, keyfile)
         
         # Connect to remote host by any address possible
-        err = None
-        for address in addresses:
-            self._debug("Connecting to: " + str(address[4]))
-            s = socket.socket(address[0], address[1])
-            if self.sync_only:
-                timeout = self.options["short_timeout"]
-            else:
-                timeout = self.options["timeout"]
-            s.settimeout(timeout)
+        # (all addresses are raced, the first connected socket is used for TLS)
+        address, s = race_connect(addresses, self._get_timeout(), debug=self._debug)
+        try:
             s = context.wrap_socket(s, server_hostname = host)
-            try:
-                s.connect(address[4])
-                break
-            except OSError as e:
-                err = e
-        else:
-            # If we couldn't connect to *any* of the addresses, just
-            # bubble up the exception from the last attempt and deny
-            # knowledge of earlier failures.
-            raise err
+        except:
+            s.close()
+            raise
 
         if sys.version_info.minor >=5:
             self._debug("Established {} connection.".format(s.version()))
@@ -2608,6 +3527,20 @@ class GeminiClient(cmd.Cmd):
         mf= s.makefile(mode = "rb")
         return address, mf
 
+    def _get_timeout(self):
+        # Sync should not wait on unresponsive servers
+        if self.sync_only:
+            return self.options["short_timeout"]
+        else:
+            return self.options["timeout"]
+
+    def _open_connection(self, host, port):
+        """Open a plain TCP connection (for gopher, finger and spartan).
+        Returns the resolved address and the connected socket."""
+        host = host.encode("idna").decode()
+        addresses = self._get_addresses(host, port)
+        return race_connect(addresses, self._get_timeout(), debug=self._debug)
+
     def _get_addresses(self, host, port):
         # DNS lookup - will get IPv4 and IPv6 records if IPv6 is enabled
         if ":" in host:
@@ -2620,12 +3553,18 @@ class GeminiClient(cmd.Cmd):
         else:
             # IPv4 only
             family_mask = socket.AF_INET
+        # Resolver cache, shared by all protocols
+        key = (host, port, family_mask)
+        if key in self.dns_cache:
+            resolved_at, addresses = self.dns_cache[key]
+            if time.time() - resolved_at < _DNS_CACHE_SECS:
+                return list(addresses)
         addresses = socket.getaddrinfo(host, port, family=family_mask,
                 type=socket.SOCK_STREAM)
         # Sort addresses so IPv6 ones come first
         addresses.sort(key=lambda add: add[0] == socket.AF_INET6, reverse=True)
-
-        return addresses
+        self.dns_cache[key] = (time.time(), addresses)
+        return list(addresses)
 
 
     def _handle_cert_request(self, meta):
@@ -2859,6 +3798,9 @@ class GeminiClient(cmd.Cmd):
         elif address[0] == socket.AF_INET6:
             self.log["ipv6_requests"] += 1
             self.log["ipv6_bytes_recvd"] += size
+        elif address[0] == "rrtp":
+            self.log["rrtp_requests"] += 1
+            self.log["rrtp_bytes_recvd"] += size
 
     def _debug(self, debug_text):
         if not self.options["debug"]:
@@ -3078,6 +4020,57 @@ class GeminiClient(cmd.Cmd):
                 else:
                     print("accept_bad_ssl_certificates should be True or False")
                     return
+            elif option == "sync_profile":
+                if value not in _SYNC_PROFILES:
+                    print("sync_profile should be one of %s" %", ".join(_SYNC_PROFILES))
+                    return
+            elif option == "rns_config":
+                if value.lower() in ("none", "default"):
+                    value = None
+                else:
+                    value = os.path.expanduser(value)
+                if self.rrtp_client:
+                    print("Reticulum is already running, restart offpunk to use this configuration")
+            elif option == "rrtp_gateway":
+                if value.lower() == "none":
+                    value = None
+                else:
+                    # rrtp://hash/ or the bare destination hash
+                    value = value.strip().strip("<>/")
+                    if value.startswith("rrtp://"):
+                        value = value[len("rrtp://"):]
+                    try:
+                        valid = len(bytes.fromhex(value)) == 16
+                    except ValueError:
+                        valid = False
+                    if not valid:
+                        print("rrtp_gateway should be the address of a RRTP node, or None")
+                        return
+                    if not _DO_RRTP:
+                        print("Install python3-rns (Reticulum) to use a RRTP gateway")
+                        return
+                self.gateway_failed = False
+            elif option == "rrtp_serve_allow":
+                if value.lower() in ("none", "all"):
+                    value = ""
+                hashes = [h.strip().strip("<>") for h in value.split(",") if h.strip()]
+                for h in hashes:
+                    try:
+                        # Reticulum hashes are 16 bytes
+                        valid = len(bytes.fromhex(h)) == 16
+                    except ValueError:
+                        valid = False
+                    if not valid:
+                        print("%s is not an identity hash" %h)
+                        return
+                value = ",".join(hashes)
+            elif option == "cache_compression":
+                if value.lower() not in ("true", "false"):
+                    print("cache_compression should be True or False")
+                    return
+                value = value.lower() == "true"
+                global _COMPRESS_CACHE
+                _COMPRESS_CACHE = value
             elif option == "width":
                 if value.isnumeric():
                     value = int(value)
@@ -3439,6 +4432,7 @@ Marks are temporary until shutdown (not saved to disk)."""
             output += " - python-pil          : " + has(_HAS_PIL)
         output += "\nNice to have:\n"
         output += " - python-setproctitle : " + has(_HAS_SETPROCTITLE)
+        output += " - python-rns          : " + has(_DO_RRTP)
         output += " - xsel                : " + has(_HAS_XSEL)
 
         output += "\nFeatures :\n"
@@ -3450,8 +4444,16 @@ Marks are temporary until shutdown (not saved to disk)."""
         output += " - Render Atom/RSS feeds (feedparser)         : " + has(_DO_FEED)
         output += " - Connect to http/https (requests)           : " + has(_DO_HTTP)
         output += " - copy to/from clipboard (xsel)              : " + has(_HAS_XSEL)
+        output += " - Connect to rrtp over Reticulum (rns)       : " + has(_DO_RRTP)
         output += " - restore last position (less 572+)          : " + has(_LESS_RESTORE_POSITION) 
         output += "\n"
+        if not self.rrtp_client:
+            reticulum = "not started"
+        elif self.rrtp_client.reticulum.is_connected_to_shared_instance:
+            reticulum = "attached to the shared instance"
+        else:
+            reticulum = "started by offpunk (no shared instance found)"
+        output += "Reticulum           : " + reticulum + "\n"
         output += "Config directory    : " +  _CONFIG_DIR + "\n"
         output += "User Data directory : " +  _DATA_DIR + "\n"
         output += "Cache directoy      : " +  _CACHE_PATH
@@ -3870,6 +4872,34 @@ archives, which is a special historical list limited in size. It is similar to `
         else:
             return False
 
+    # replace an url by another in a list, keeping its position and title
+    # return True if the URL was found
+    def list_replace_url(self,url,new_url,list):
+        list_path = self.list_path(list)
+        if not list_path:
+            return False
+        with open(list_path,"r") as lf:
+            lines = lf.readlines()
+            lf.close()
+        replaced = False
+        to_write = []
+        for l in lines:
+            splitted = l.split(maxsplit=2)
+            if len(splitted) > 1 and splitted[0] == "=>":
+                current = splitted[1].split("##offpunk_mode=")
+                #sometimes, the list doesn’t have the ending "/"
+                if current[0] == url or current[0] + "/" == url:
+                    current[0] = new_url
+                    l = l.replace(splitted[1],"##offpunk_mode=".join(current),1)
+                    replaced = True
+            to_write.append(l)
+        if replaced:
+            with open(list_path,"w") as lf:
+                for l in to_write:
+                    lf.write(l)
+                lf.close()
+        return replaced
+
     def list_get_links(self,list):
         list_path = self.list_path(list)
         if list_path:
@@ -4127,30 +5157,44 @@ Note: There’s no "delete" on purpose. The use of "archive" is recommended."""
             cmd.Cmd.do_help(self, arg)
 
     ### Flight recorder
-    def do_blackbox(self, *args):
+    def do_blackbox(self, line):
         """Display contents of flight recorder, showing statistics for the
-current gemini browsing session."""
+current gemini browsing session.
+"blackbox json" exports them as JSON, with the statistics of each RRTP node."""
         lines = []
         # Compute flight time
         now = time.time()
         delta = now - self.log["start_time"]
         hours, remainder = divmod(delta, 3600)
         minutes, seconds = divmod(remainder, 60)
+        rrtp_stats = {}
+        if self.rrtp_client:
+            rrtp_stats = self.rrtp_client.stats
+        if line.strip() == "json":
+            log = dict(self.log)
+            log["duration"] = delta
+            print(json.dumps({"session": log, "rrtp": rrtp_stats}, indent=2))
+            return
         # Count hosts
         ipv4_hosts = len([host for host in self.visited_hosts if host[0] == socket.AF_INET])
         ipv6_hosts = len([host for host in self.visited_hosts if host[0] == socket.AF_INET6])
+        rrtp_hosts = len([host for host in self.visited_hosts if host[0] == "rrtp"])
         # Assemble lines
         lines.append(("Patrol duration", "%02d:%02d:%02d" % (hours, minutes, seconds)))
         lines.append(("Requests sent:", self.log["requests"]))
         lines.append(("   IPv4 requests:", self.log["ipv4_requests"]))
         lines.append(("   IPv6 requests:", self.log["ipv6_requests"]))
+        lines.append(("   RRTP requests:", self.log["rrtp_requests"]))
         lines.append(("Bytes received:", self.log["bytes_recvd"]))
         lines.append(("   IPv4 bytes:", self.log["ipv4_bytes_recvd"]))
         lines.append(("   IPv6 bytes:", self.log["ipv6_bytes_recvd"]))
+        lines.append(("   RRTP bytes:", self.log["rrtp_bytes_recvd"]))
         lines.append(("Unique hosts visited:", len(self.visited_hosts)))
         lines.append(("   IPv4 hosts:", ipv4_hosts))
         lines.append(("   IPv6 hosts:", ipv6_hosts))
+        lines.append(("   RRTP nodes:", rrtp_hosts))
         lines.append(("DNS failures:", self.log["dns_failures"]))
+        lines.append(("RRTP failures:", self.log["rrtp_failures"]))
         lines.append(("Timeouts:", self.log["timeouts"]))
         lines.append(("Refused connections:", self.log["refused_connections"]))
         lines.append(("Reset connections:", self.log["reset_connections"]))
@@ -4158,6 +5202,28 @@ current gemini browsing session."""
         # Print
         for key, value in lines:
             print(key.ljust(24) + str(value).rjust(8))
+        # Where is the time spent over Reticulum?
+        def seconds(value):
+            if value is None:
+                return "-"
+            return "%.2fs" %value
+        for node, stats in sorted(rrtp_stats.items()):
+            print("\nRRTP node %s" %node)
+            if stats["transfer_time"] > 0:
+                throughput = "%.1f kb/s" %(stats["bytes"]*8/stats["transfer_time"]/1000)
+            else:
+                throughput = "-"
+            node_lines = []
+            node_lines.append(("   Path discovery:", seconds(stats["path_time"])))
+            node_lines.append(("   Link establishment:", seconds(stats["link_time"])))
+            node_lines.append(("   Round-trip time:", seconds(stats["rtt"])))
+            node_lines.append(("   Links established:", stats["links"]))
+            node_lines.append(("   Requests:", stats["requests"]))
+            node_lines.append(("   Failed requests:", stats["failures"]))
+            node_lines.append(("   Bytes received:", stats["bytes"]))
+            node_lines.append(("   Throughput:", throughput))
+            for key, value in node_lines:
+                print(key.ljust(24) + str(value).rjust(12))
 
     
     def do_sync(self, line):
@@ -4190,6 +5256,13 @@ Argument : duration of cache validity (in seconds)."""
         # - validity : the age, in seconds, existing caches need to have before
         #               being refreshed (0 = never refreshed if it already exists)
         # - savetotour : if True, newly cached items are added to tour
+        # - removefrom : list from which the item is removed once in tour
+        # Depending on the sync profile, binaries are not fetched immediately
+        # but kept in "deferred" and fetched once all the text is there.
+        profile = _SYNC_PROFILES[self.options["sync_profile"]]
+        deferred = []
+        # rrtp pages of a same node are prefetched together, see prefetch_rrtp
+        max_download = int(self.options["max_size_download"])*1000000
         def add_to_tour(gitem):
             if gitem and gitem.is_cache_valid():
                 toprint = "  -> adding to tour: %s" %gitem.url
@@ -4201,12 +5274,49 @@ Argument : duration of cache validity (in seconds)."""
                 return True
             else:
                 return False
-        def fetch_gitem(gitem,depth=0,validity=0,savetotour=False,count=[0,0],strin=""):
+        def prefetch_rrtp(gitems,validity=0,savetotour=False):
+            # When several items are on the same RRTP node, they are fetched
+            # in one exchange before fetch_gitem goes through them (and find
+            # them in the cache).
+            if not _DO_RRTP:
+                return
+            nodes = {}
+            for gitem in gitems:
+                if gitem and gitem.scheme == "rrtp" \
+                        and not gitem.is_cache_valid(validity=validity) \
+                        and not (profile["defer_binaries"] \
+                                    and is_binary_mime(gitem.expected_mime())):
+                    nodes.setdefault(gitem.host,[]).append(gitem)
+            batch = [g for items in nodes.values() if len(items) > 1 for g in items]
+            if not batch:
+                return
+            # as in fetch_gitem, only new content goes to tour
+            new = [g.url for g in batch if not g.is_cache_valid()]
+            print(" * * * Fetching %s RRTP pages together * * *" %len(batch))
+            try:
+                fetched = self._fetch_rrtp_many(batch,max_length=max_download)
+            except Exception as err:
+                # fetch_gitem will try them one by one
+                return
+            for gitem in fetched:
+                if savetotour and gitem.url in new:
+                    add_to_tour(gitem)
+        def fetch_gitem(gitem,depth=0,validity=0,savetotour=False,count=[0,0],strin="",\
+                                                                removefrom=None):
             #savetotour = True will save to tour newly cached content
             # else, do not save to tour
             #regardless of valitidy
             if not gitem: return
+            # Directly fetch the target of known redirections
+            redirect = self._get_redirect(gitem.url)
+            if redirect:
+                gitem = GeminiItem(redirect, name=gitem.name)
             if not gitem.is_cache_valid(validity=validity):
+                if profile["defer_binaries"] and is_binary_mime(gitem.expected_mime()):
+                    # as below, only new content goes to tour
+                    totour = savetotour and not gitem.is_cache_valid()
+                    deferred.append((gitem,validity,totour,removefrom))
+                    return
                 if strin != "":
                     endline = '\r'
                 else:
@@ -4236,6 +5346,7 @@ Argument : duration of cache validity (in seconds)."""
                 # The code for this was removed so, currently, we savetotour
                 # at every level of recursion.
                 links = gitem.get_links(mode="links_only")
+                prefetch_rrtp(links,savetotour=savetotour)
                 subcount = [0,len(links)]
                 d = depth - 1
                 for k in links:
@@ -4249,14 +5360,59 @@ Argument : duration of cache validity (in seconds)."""
             end = len(links)
             counter = 0
             print(" * * * %s to fetch in %s * * *" %(end,list))
+            prefetch_rrtp(links,validity=validity,savetotour=tourchildren)
             for l in links:
                 counter += 1
+                if self.options["rewrite_redirected_links"]:
+                    redirect = self._get_redirect(l.url,permanent_only=True)
+                    if redirect and self.list_replace_url(l.url,redirect,list):
+                        print("  -> %s moved to %s" %(l.url,redirect))
+                        l = GeminiItem(redirect, name=l.name)
                 # If cache for a link is newer than the list
-                fetch_gitem(l,depth=depth,validity=validity,savetotour=tourchildren,count=[counter,end])
+                if tourandremove:
+                    removefrom = list
+                else:
+                    removefrom = None
+                fetch_gitem(l,depth=depth,validity=validity,savetotour=tourchildren,\
+                                            count=[counter,end],removefrom=removefrom)
                 if tourandremove:
                     if add_to_tour(l):
                         self.list_rm_url(l.url_mode(),list)
             
+        def fetch_deferred(items,budget):
+            # images are usually smaller than archives, audio or video
+            def rank(item):
+                mime = item[0].expected_mime() or ""
+                return not mime.startswith("image/")
+            items = sorted(items,key=rank)
+            if budget is not None:
+                budget = budget*1000000
+            end = len(items)
+            counter = 0
+            skipped = 0
+            print(" * * * %s deferred binaries to fetch * * *" %end)
+            for gitem,validity,totour,removefrom in items:
+                counter += 1
+                # an item might have been linked twice
+                if gitem.is_cache_valid(validity=validity):
+                    continue
+                if budget is not None and budget <= 0:
+                    skipped += 1
+                    continue
+                toprint = " [%s/%s] Fetch "%(counter,end) + gitem.url
+                width = term_width() - 1
+                toprint = toprint[:width]
+                toprint += " "*(width-len(toprint))
+                print(toprint)
+                self._go_to_gi(gitem,update_hist=False,limit_size=True,max_size=budget)
+                if gitem.is_cache_valid():
+                    if budget is not None:
+                        budget -= os.path.getsize(gitem.get_cache_path())
+                    if (totour or removefrom) and add_to_tour(gitem) and removefrom:
+                        self.list_rm_url(gitem.url_mode(),removefrom)
+            if skipped > 0:
+                print(" * * * %s binaries skipped (sync budget exhausted) * * *" %skipped)
+
         self.sync_only = True
         lists = self.list_lists()
         # We will fetch all the lists except "archives" and "history"
@@ -4272,6 +5428,10 @@ Argument : duration of cache validity (in seconds)."""
                     subscriptions.append(l)
                 else:
                     normal_lists.append(l)
+        if _DO_RRTP:
+            synced = subscriptions + normal_lists + fridge
+            synced += [l for l in ["to_fetch","tour"] if l in lists]
+            self._request_rrtp_paths(synced,validity=refresh_time)
         # We start with the "subscribed" as we need to find new items
         starttime = int(time.time())
         for l in subscriptions:
@@ -4289,6 +5449,10 @@ Argument : duration of cache validity (in seconds)."""
             fetch_list(l,validity=0,depth=depth)
         #tour should be the last one as item my be added to it by others
         fetch_list("tour",validity=refresh_time,depth=depth)
+        #Binaries deferred by the sync profile come last
+        if deferred:
+            fetch_deferred(deferred,profile["binary_budget"])
+        self._save_rrtp_state()
         print("End of sync")
         self.sync_only = False
 
@@ -4301,8 +5465,13 @@ Argument : duration of cache validity (in seconds)."""
         # Close TOFU DB
         self.db_conn.commit()
         self.db_conn.close()
+        self.redirects_conn.close()
+        if self.rrtp_client:
+            self._save_rrtp_state()
+            self.rrtp_conn.close()
         # Clean up after ourself
-
+        for copy in _UNCOMPRESSED_COPIES.values():
+            unlink(copy)
         for cert in self.transient_certs_created:
             for ext in (".crt", ".key"):
                 certfile = os.path.join(_CONFIG_DIR, "transient_certs", cert+ext)
@@ -4336,6 +5505,16 @@ def main():
                         help='depth of the cache to build. Default is 1. More is crazy. Use at your own risks!')
     parser.add_argument('--cache-validity', 
                         help='duration for which a cache is valid before sync (seconds)')
+    parser.add_argument('--sync-profile', choices=list(_SYNC_PROFILES),
+                        help='when to download binaries during sync: full (default), textfirst (after text), metered (after text, 20 Mo max), textonly (never)')
+    parser.add_argument('--serve-rrtp', action='store_true',
+                        help='run non-interactively to serve the cache, read-only, to Reticulum peers')
+    parser.add_argument('--record', metavar='ARCHIVE',
+                        help='record every network fetch in ARCHIVE (a SQLite file)')
+    parser.add_argument('--replay', metavar='ARCHIVE',
+                        help='answer fetches from ARCHIVE instead of the network, as slowly as they were recorded')
+    parser.add_argument('--replay-fast', action='store_true',
+                        help='with --replay, answer without the recorded delays')
     parser.add_argument('--version', action='store_true',
                         help='display version information and quit')
     parser.add_argument('--features', action='store_true',
@@ -4379,9 +5558,9 @@ def main():
                         else:
                             print("Skipping rc command \"%s\" due to provided URLs." % line)
                         continue
-                    # We always consider redirect
+                    # We always consider redirect and settings
                     # for the rest, we need to be interactive
-                    if line.startswith("redirect") or interactive:
+                    if line.startswith(("redirect", "set ")) or interactive:
                         queue.append(line)
         return queue
     # Act on args
@@ -4400,9 +5579,28 @@ def main():
 
     if args.disable_http:
         gc.support_http = False
-
-    # Endless interpret loop (except while --sync or --fetch-later)
-    if args.fetch_later:
+    if args.record and args.replay:
+        print("--record and --replay can’t be used together")
+        sys.exit(1)
+    elif args.record:
+        gc.use_archive(FetchArchive(args.record))
+    elif args.replay:
+        gc.use_archive(FetchArchive(args.replay, replay=True, realtime=not args.replay_fast))
+
+    # Endless interpret loop (except while --sync, --fetch-later or --serve-rrtp)
+    if args.serve_rrtp:
+        if not _DO_RRTP:
+            print("Install python3-rns (Reticulum) to serve the cache over RRTP")
+            sys.exit(1)
+        # Only the settings of the config file apply here
+        for line in read_config(torun_queue, interactive=True):
+            if line.startswith("set "):
+                gc.onecmd(line)
+        try:
+            gc.serve_rrtp()
+        except KeyboardInterrupt:
+            print("")
+    elif args.fetch_later:
         if args.url:
             gc.sync_only = True
             for u in args.url:
@@ -4414,6 +5612,9 @@ def main():
         else:
             print("--fetch-later requires an URL (or a list of URLS) as argument")
     elif args.sync:
+        # The config file first: the command line options win
+        for line in read_config([], interactive=False):
+            gc.onecmd(line)
         if args.assume_yes:
             gc.automatic_choice = "y"
             gc.onecmd("set accept_bad_ssl_certificates True")
@@ -4426,9 +5627,10 @@ def main():
             depth = int(args.depth)
         else:
             depth = 1
-        read_config(torun_queue, interactive=False)
         for line in torun_queue:
             gc.onecmd(line)
+        if args.sync_profile:
+            gc.options["sync_profile"] = args.sync_profile
         gc.call_sync(refresh_time=refresh_time,depth=depth)
         gc.onecmd("blackbox")
     else:
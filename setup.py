@@ -15,7 +15,7 @@ setup(
         'Environment :: Console',
         'Development Status :: 4 - Beta',
     ],
-    py_modules = ["offpunk"],
+    py_modules = ["offpunk", "RRTPRequest", "RRTPServer"],
     entry_points={
         "console_scripts": ["offpunk=offpunk:main"]
     },